@@ -1,16 +1,31 @@
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
 from trytond.pool import Pool
+from . import account
 from . import configuration
+from . import ir
 from . import party
+from . import product
+from . import res
 from . import sale
 from . import shop
+from . import ticket
 
 
 def register():
     Pool.register(
         configuration.Configuration,
         configuration.ConfigurationSequence,
+        ir.Cron,
+        account.Tax,
+        account.TaxRule,
+        account.TaxRuleLine,
+        party.Party,
+        product.Template,
+        product.Category,
+        product.Product,
+        product.ProductIdentifier,
+        res.User,
         sale.Sale,
         sale.SaleLine,
         sale.StatementLine,
@@ -18,12 +33,24 @@ def register():
         sale.ChooseProductForm,
         sale.SalePaymentForm,
         shop.SaleShop,
+        shop.BarcodeLayout,
+        shop.CloseDayStart,
+        ticket.TicketCache,
         module='sale_pos', type_='model')
     Pool.register(
         party.PartyReplace,
         sale.WizardAddProduct,
         sale.WizardSalePayment,
+        shop.CloseDay,
         module='sale_pos', type_='wizard')
+    Pool.register(
+        ticket.SaleReport,
+        module='sale_pos', type_='report')
+    Pool.register(
+        product.PriceList,
+        product.PriceListLine,
+        module='sale_pos', type_='model',
+        depends=['product_price_list'])
     Pool.register(
         sale.SaleShipmentCost,
         module='sale_pos', type_='model',
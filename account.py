@@ -0,0 +1,52 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+
+class Tax(metaclass=PoolMeta):
+    __name__ = 'account.tax'
+
+    @classmethod
+    def on_modification(cls, mode, taxes, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, taxes, field_names=field_names)
+        SaleLine._pos_price_cache.clear()
+
+    @classmethod
+    def compute(cls, taxes, price_unit, quantity, date):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        if not Transaction().context.get('_sale_pos_price_cache'):
+            return super().compute(taxes, price_unit, quantity, date)
+        key = ('taxes', tuple(t.id for t in taxes), price_unit, quantity,
+            date)
+        rows = SaleLine._pos_price_cache.get(key)
+        if rows is None:
+            rows = [{**r, 'tax': r['tax'].id}
+                for r in super().compute(taxes, price_unit, quantity, date)]
+            SaleLine._pos_price_cache.set(key, rows)
+        return [{**r, 'tax': cls(r['tax'])} for r in rows]
+
+
+class TaxRule(metaclass=PoolMeta):
+    __name__ = 'account.tax.rule'
+
+    @classmethod
+    def on_modification(cls, mode, rules, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, rules, field_names=field_names)
+        SaleLine._pos_price_cache.clear()
+
+
+class TaxRuleLine(metaclass=PoolMeta):
+    __name__ = 'account.tax.rule.line'
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, lines, field_names=field_names)
+        SaleLine._pos_price_cache.clear()
@@ -24,6 +24,9 @@ class Configuration(metaclass=PoolMeta):
             ('sequence_type', '=', Id('sale_pos', 'sequence_type_sale_pos')),
             ]))
     ticket_report = fields.Many2One('ir.action.report', "Ticket Report")
+    pos_append_lines = fields.Boolean("Append Scanned Lines",
+        help="Add a new line each time a product is scanned instead of "
+        "increasing the quantity of its existing line.")
 
     @classmethod
     def __register__(cls, module_name):
@@ -31,6 +34,13 @@ class Configuration(metaclass=PoolMeta):
         table = cls.__table_handler__(module_name)
         table.not_null_action('ticket_report', action='remove')
 
+    @classmethod
+    def on_modification(cls, mode, configurations, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, configurations, field_names=field_names)
+        SaleLine._pos_defaults_cache.clear()
+
     @classmethod
     def multivalue_model(cls, field):
         pool = Pool()
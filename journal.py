@@ -0,0 +1,105 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import json
+import os
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+
+class PosJournal:
+    """
+    Append-only journal of the sales recorded by a terminal while the server
+    can not be reached.
+
+    Each sale and each acknowledgement is written as a line of JSON so a
+    crash can only lose the line being written. The pending sales are sent to
+    the replay_pos_sales method of sale.sale once the server is available.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(',', ':'), default=str) + '\n'
+        with open(self.path, 'a+b') as file:
+            if file.tell():
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    # Start a new line after a line truncated by a crash
+                    line = '\n' + line
+            file.write(line.encode('utf-8'))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _records(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # The last line may be truncated by a crash
+                    continue
+
+    def record(self, lines, payments=None, party=None, self_pick_up=None,
+            date=None, key=None):
+        """
+        Record a sale of lines, a list of (code, quantity), paid with
+        payments, a list of (journal id, amount).
+        Returns the key that identifies the sale.
+        """
+        entry = {
+            'key': key or str(uuid.uuid4()),
+            'date': (date or datetime.now()).isoformat(),
+            'lines': [[c, q] for c, q in lines],
+            # Convert floats by their repr, not their binary expansion
+            'payments': [[j, str(Decimal(str(a)))] for j, a in payments or []],
+            }
+        if party is not None:
+            entry['party'] = party
+        if self_pick_up is not None:
+            entry['self_pick_up'] = self_pick_up
+        self._append(entry)
+        return entry['key']
+
+    def acknowledge(self, keys):
+        "Mark the sales of keys as replayed"
+        for key in keys:
+            self._append({'ack': key})
+
+    def pending(self):
+        "Return the entries not yet replayed in the order they were recorded"
+        entries, acknowledged = {}, set()
+        for record in self._records():
+            if 'ack' in record:
+                acknowledged.add(record['ack'])
+            else:
+                entries.setdefault(record['key'], record)
+        return [e for k, e in entries.items() if k not in acknowledged]
+
+    def replay(self, replay_pos_sales, batch_size=100):
+        """
+        Send the pending entries by batches to replay_pos_sales and
+        acknowledge the replayed ones.
+        Returns the unknown codes of the entries that could not be replayed.
+        """
+        unknown = {}
+        pending = self.pending()
+        for i in range(0, len(pending), batch_size):
+            result = replay_pos_sales(pending[i:i + batch_size])
+            self.acknowledge(result['sales'])
+            unknown.update(result['unknown'])
+        return unknown
+
+    def compact(self):
+        "Rewrite the journal with only the pending entries"
+        pending = self.pending()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            for entry in pending:
+                file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,103 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+# Upper bounds in milliseconds of the buckets of the histograms
+BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+_null = nullcontext()
+_histograms = OrderedDict()
+_lock = threading.Lock()
+
+
+def enabled():
+    return config.getboolean('sale_pos', 'metrics', default=False)
+
+
+def measure(stage):
+    """
+    Return a context manager recording the duration and the number of records
+    written of stage for the shop and the user of the transaction.
+    It does nothing unless the metrics option is set.
+    """
+    if not enabled():
+        return _null
+    return _measure(stage)
+
+
+@contextmanager
+def _measure(stage):
+    transaction = Transaction()
+    counter = transaction.counter
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = (time.perf_counter() - start) * 1000
+        record(stage, transaction.context.get('shop'), transaction.user,
+            duration, transaction.counter - counter)
+
+
+def record(stage, shop, user, duration, writes):
+    "Add a measure of duration milliseconds to the histogram of stage"
+    key = (stage, shop, user)
+    size = config.getint('sale_pos', 'metrics_size', default=1000)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': [0] * (len(BOUNDS) + 1),
+                'count': 0,
+                'sum': 0.,
+                'max': 0.,
+                'writes': 0,
+                }
+            while len(_histograms) > size:
+                _histograms.popitem(last=False)
+        else:
+            _histograms.move_to_end(key)
+        histogram['buckets'][bisect_left(BOUNDS, duration)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += duration
+        histogram['max'] = max(histogram['max'], duration)
+        histogram['writes'] += writes
+
+
+def get():
+    "Return the histograms recorded by the process"
+    with _lock:
+        return [{
+                'stage': stage,
+                'shop': shop,
+                'user': user,
+                'bounds': list(BOUNDS),
+                'buckets': list(h['buckets']),
+                'count': h['count'],
+                'sum': h['sum'],
+                'max': h['max'],
+                'writes': h['writes'],
+                } for (stage, shop, user), h in _histograms.items()]
+
+
+def clear():
+    with _lock:
+        _histograms.clear()
+
+
+def timed(stage):
+    "Decorator to measure each call of the function as stage"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,8 +1,20 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
 
-__all__ = ['PartyReplace']
+__all__ = ['Party', 'PartyReplace']
+
+
+class Party(metaclass=PoolMeta):
+    __name__ = 'party.party'
+
+    @classmethod
+    def on_modification(cls, mode, parties, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, parties, field_names=field_names)
+        if mode == 'write' and 'customer_tax_rule' in field_names:
+            SaleLine._pos_price_cache.clear()
 
 
 class PartyReplace(metaclass=PoolMeta):
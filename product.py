@@ -0,0 +1,185 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import escape_wildcard, grouped_slice
+from trytond.transaction import Transaction
+
+
+class Template(metaclass=PoolMeta):
+    __name__ = 'product.template'
+
+    @classmethod
+    def on_modification(cls, mode, templates, field_names=None):
+        pool = Pool()
+        Product = pool.get('product.product')
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, templates, field_names=field_names)
+        if (mode != 'write'
+                or field_names & {'salable', 'active', 'code'}):
+            Product._pos_code_cache.clear()
+        SaleLine._pos_price_cache.clear()
+
+
+class Category(metaclass=PoolMeta):
+    __name__ = 'product.category'
+
+    @classmethod
+    def on_modification(cls, mode, categories, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, categories, field_names=field_names)
+        SaleLine._pos_price_cache.clear()
+
+
+class Product(metaclass=PoolMeta):
+    __name__ = 'product.product'
+    _pos_code_cache = Cache('product.product.pos_code', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, products, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, products, field_names=field_names)
+        if (mode != 'write'
+                or field_names & {'code', 'suffix_code', 'active', 'template'}):
+            cls._pos_code_cache.clear()
+        SaleLine._pos_price_cache.clear()
+
+    @classmethod
+    def search_pos_code(cls, code):
+        """
+        Return the salable products whose code or one of its identifiers is
+        exactly code.
+        """
+        return cls.search_pos_codes([code])[code]
+
+    @classmethod
+    def search_pos_codes(cls, codes):
+        """
+        Return a dictionary with the salable products matching exactly each
+        code by their code or one of their identifiers.
+        The result is cached per company until a product, template or
+        identifier is modified.
+        """
+        company = Transaction().context.get('company')
+        result, missing = {}, []
+        for code in set(codes):
+            product_ids = cls._pos_code_cache.get((company, code))
+            if product_ids is None:
+                missing.append(code)
+            else:
+                result[code] = product_ids
+        if missing:
+            found = {c: [] for c in missing}
+            for sub_codes in grouped_slice(missing):
+                sub_codes = list(sub_codes)
+                products = cls.search([
+                        ('salable', '=', True),
+                        ['OR',
+                            ('code', 'in', sub_codes),
+                            ('identifiers.code', 'in', sub_codes),
+                            ],
+                        ])
+                for product in products:
+                    product_codes = {product.code}
+                    product_codes.update(i.code for i in product.identifiers)
+                    for code in product_codes:
+                        if code in found:
+                            found[code].append(product.id)
+            for code, product_ids in found.items():
+                cls._pos_code_cache.set((company, code), product_ids)
+                result[code] = product_ids
+        return {c: cls.browse(ids) for c, ids in result.items()}
+
+    @classmethod
+    def _pos_search_stages(cls, value):
+        """
+        Return the list of (domain, order) searched in turn to resolve value
+        when no product matches its code or identifiers exactly.
+        The first stage returning products is used.
+        """
+        database = Transaction().database
+        value = escape_wildcard(value)
+        if database.has_similarity():
+            # Rank by trigram similarity on the indexed template name
+            name_order = [('template.name', 'DESC')]
+        else:
+            name_order = None
+        return [
+            ([
+                    ('salable', '=', True),
+                    ['OR',
+                        ('code', 'ilike', value + '%'),
+                        ('template.name', 'ilike', value + '%'),
+                        ],
+                    ], None),
+            ([
+                    ('salable', '=', True),
+                    ('template.name', 'ilike', '%' + value + '%'),
+                    ], name_order),
+            ]
+
+    @classmethod
+    def is_pos_candidate(cls, product, value):
+        "Return if product is one of the candidates for the scanned value"
+        if product in cls.search_pos_code(value):
+            return True
+        for domain, _ in cls._pos_search_stages(value):
+            if cls.search([('id', '=', product.id), domain], count=True):
+                return True
+        return False
+
+    @classmethod
+    def search_pos_products(cls, value):
+        """
+        Return the ranked candidate products for the scanned value, stopping
+        at the first stage with results and never more than a page of them.
+        """
+        products = cls.search_pos_code(value)
+        if products:
+            return products
+
+        limit = config.getint('sale_pos', 'scan_limit', default=50)
+        for domain, order in cls._pos_search_stages(value):
+            with Transaction().set_context(**{
+                        'product.template.name.order': value,
+                        }):
+                products = cls.search(domain, limit=limit, order=order)
+            if products:
+                return products
+        return []
+
+
+class ProductIdentifier(metaclass=PoolMeta):
+    __name__ = 'product.identifier'
+
+    @classmethod
+    def on_modification(cls, mode, identifiers, field_names=None):
+        pool = Pool()
+        Product = pool.get('product.product')
+        super().on_modification(mode, identifiers, field_names=field_names)
+        Product._pos_code_cache.clear()
+
+
+class PriceList(metaclass=PoolMeta):
+    __name__ = 'product.price_list'
+
+    @classmethod
+    def on_modification(cls, mode, price_lists, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, price_lists, field_names=field_names)
+        SaleLine._pos_price_cache.clear()
+
+
+class PriceListLine(metaclass=PoolMeta):
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        super().on_modification(mode, lines, field_names=field_names)
+        SaleLine._pos_price_cache.clear()
@@ -0,0 +1,15 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+
+class User(metaclass=PoolMeta):
+    __name__ = 'res.user'
+
+    @classmethod
+    def on_modification(cls, mode, users, field_names=None):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        super().on_modification(mode, users, field_names=field_names)
+        if mode != 'write' or 'shop' in field_names:
+            Sale.clear_pos_context()
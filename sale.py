@@ -1,17 +1,37 @@
 # This file is part of sale_pos module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import logging
+from collections import defaultdict
+from copy import deepcopy
 from decimal import Decimal
 from datetime import datetime
-from trytond.model import ModelView, fields
+from itertools import islice
+from weakref import WeakKeyDictionary
+from sql import Literal, Null
+from sql.aggregate import Count, Max
+from sql.operators import Equality
+from trytond.cache import Cache, freeze
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.i18n import gettext
+from trytond.model import Exclude, Index, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Bool, Eval, Or
+from trytond.rpc import RPC
+from trytond.tools import cached_property
 from trytond.wizard import (Wizard, StateView, StateTransition,
     Button)
-from functools import reduce
+
+from . import metrics, scan
+
+logger = logging.getLogger(__name__)
 
 _ZERO = Decimal('0.00')
+_pos_context_cache = WeakKeyDictionary()
+_context_sales = WeakKeyDictionary()
+_MISSING = object()
 
 
 class Sale(metaclass=PoolMeta):
@@ -24,17 +44,80 @@ class Sale(metaclass=PoolMeta):
         help='The goods are picked up by the customer before the sale, so no '
         'shipment is created.')
     pos_create_date = fields.DateTime('Create Date', readonly=True)
+    pos_client_key = fields.Char("Client Key", readonly=True,
+        help="The key given by the terminal that recorded the sale offline.")
+    _pos_session_cache = Cache('sale.sale.pos_session',
+        duration=config.getint('sale_pos', 'session_timeout', default=900),
+        context=False)
 
     @classmethod
     def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+
+        # The unique constraint can not be added on duplicated ticket numbers
+        if (table_h.column_exist('ticket_number')
+                and table_h.column_exist('shop')):
+            duplicates = cls._ticket_number_duplicates()
+            if duplicates:
+                logger.error("Sales share ticket numbers, renumber them to "
+                    "add the unique constraint (company, shop, ticket "
+                    "number): %s", duplicates)
+
+        super(Sale, cls).__register__(module_name)
+        # The fill commits each chunk so it is only run on demand during the
+        # update, otherwise the scheduled action fills the dates
+        if config.getboolean(
+                'sale_pos', 'update_pos_create_date', default=False):
+            cls.fill_pos_create_date()
+
+    @classmethod
+    def _ticket_number_duplicates(cls, limit=10):
+        "Return the (company, shop, ticket number) shared by many sales"
         cursor = Transaction().connection.cursor()
         sql_table = cls.__table__()
+        cursor.execute(*sql_table.select(
+                sql_table.company, sql_table.shop, sql_table.ticket_number,
+                where=sql_table.ticket_number != Null,
+                group_by=[
+                    sql_table.company, sql_table.shop,
+                    sql_table.ticket_number],
+                having=Count(Literal('*')) > 1,
+                limit=limit))
+        return cursor.fetchall()
 
-        super(Sale, cls).__register__(module_name)
-        cursor.execute(*sql_table.update(
-                columns=[sql_table.pos_create_date],
-                values=[sql_table.create_date],
-                where=sql_table.pos_create_date == None))
+    @classmethod
+    def fill_pos_create_date(cls):
+        """
+        Fill the POS create date of the sales without one by chunks of ids,
+        committing each chunk so the table is never locked as a whole.
+        """
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        sql_table = cls.__table__()
+
+        cursor.execute(*sql_table.select(sql_table.id,
+                where=sql_table.pos_create_date == Null,
+                order_by=[sql_table.id.asc], limit=1))
+        row = cursor.fetchone()
+        if not row:
+            return
+        first, = row
+        cursor.execute(*sql_table.select(Max(sql_table.id)))
+        last, = cursor.fetchone()
+        size = config.getint(
+            'sale_pos', 'pos_create_date_chunk', default=10000)
+        for lower in range(first, last + 1, size):
+            upper = min(lower + size, last + 1)
+            cursor = transaction.connection.cursor()
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.pos_create_date],
+                    values=[sql_table.create_date],
+                    where=((sql_table.id >= lower)
+                        & (sql_table.id < upper)
+                        & (sql_table.pos_create_date == Null))))
+            transaction.commit()
+            logger.info("Filled POS create date of sales up to %s/%s",
+                upper - 1, last)
 
     @classmethod
     def __setup__(cls):
@@ -57,12 +140,68 @@ class Sale(metaclass=PoolMeta):
                     },
                 'print_ticket': {}
                 })
+        cls.__rpc__.update({
+                'add_pos_codes': RPC(readonly=False, instantiate=0),
+                'replay_pos_sales': RPC(readonly=False),
+                'pos_scan': RPC(readonly=False, instantiate=0),
+                'edit_pos_lines': RPC(readonly=False, instantiate=0),
+                'import_pos_sales': RPC(readonly=False),
+                'pos_metrics': RPC(),
+                })
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.shop, Index.Equality()),
+                    (t.pos_create_date, Index.Range())),
+                Index(t, (t.ticket_number, Index.Equality())),
+                Index(t, (t.ticket_number, Index.Similarity())),
+                Index(t, (t.id, Index.Range()),
+                    where=t.pos_create_date == Null),
+                })
+        cls._sql_constraints += [
+            ('ticket_number_shop_unique', Exclude(t,
+                    (t.company, Equality()),
+                    (t.shop, Equality()),
+                    (t.ticket_number, Equality()),
+                    where=t.ticket_number != Null),
+                'sale_pos.msg_sale_ticket_number_unique'),
+            ('pos_client_key_unique', Exclude(t,
+                    (t.company, Equality()),
+                    (t.pos_client_key, Equality()),
+                    where=t.pos_client_key != Null),
+                'sale_pos.msg_sale_pos_client_key_unique'),
+            ]
+
+    @classmethod
+    def get_pos_context(cls):
+        """
+        Return the shop of the user with its default party.
+        It is read once per transaction and user.
+        """
+        pool = Pool()
+        User = pool.get('res.user')
+        transaction = Transaction()
+        cache = _pos_context_cache.setdefault(transaction, {})
+        if transaction.user not in cache:
+            shop = User(transaction.user).shop
+            cache[transaction.user] = {
+                'shop': shop.id if shop else None,
+                'party': shop.party.id if shop and shop.party else None,
+                }
+        return cache[transaction.user]
+
+    @classmethod
+    def clear_pos_context(cls):
+        "Clear the POS context cached by the current transaction"
+        _pos_context_cache.pop(Transaction(), None)
 
     @staticmethod
-    def default_party():
-        User = Pool().get('res.user')
-        user = User(Transaction().user)
-        return user.shop.party.id if user.shop and user.shop.party else None
+    def default_pos_create_date():
+        return datetime.now()
+
+    @classmethod
+    def default_party(cls):
+        return cls.get_pos_context()['party']
 
     @fields.depends(methods=['on_change_self_pick_up'])
     def on_change_shop(self):
@@ -90,6 +229,24 @@ class Sale(metaclass=PoolMeta):
             if self.party:
                 self.shipment_address = self.party.address_get(type='delivery')
 
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        domain = super().search_rec_name(name, clause)
+        _, operator, value = clause
+        if operator.startswith('!') or operator.startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        return [bool_op,
+            domain,
+            ('ticket_number', operator, value),
+            ]
+
+    @classmethod
+    def on_modification(cls, mode, sales, field_names=None):
+        super().on_modification(mode, sales, field_names=field_names)
+        _context_sales.pop(Transaction(), None)
+
     @classmethod
     def view_attributes(cls):
         return super(Sale, cls).view_attributes() + [
@@ -98,12 +255,19 @@ class Sale(metaclass=PoolMeta):
                     })]
 
     @classmethod
-    def create(cls, vlist):
-        now = datetime.now()
-        vlist = [x.copy() for x in vlist]
-        for vals in vlist:
-            vals['pos_create_date'] = now
-        return super(Sale, cls).create(vlist)
+    def import_pos_sales(cls, vlist):
+        """
+        Create the sales from an iterable of values by batches of
+        import_batch so the values do not need to be all in memory.
+        The pos_create_date of the values is kept to record the time the sale
+        was captured.
+        Returns the ids of the created sales.
+        """
+        size = config.getint('sale_pos', 'import_batch', default=1000)
+        ids, vlist = [], iter(vlist)
+        while sub_vlist := list(islice(vlist, size)):
+            ids.extend(s.id for s in cls.create(sub_vlist))
+        return ids
 
     @classmethod
     def copy(cls, sales, default=None):
@@ -111,6 +275,8 @@ class Sale(metaclass=PoolMeta):
             default = {}
         default = default.copy()
         default['ticket_number'] = None
+        default['pos_client_key'] = None
+        default['pos_create_date'] = lambda data: cls.default_pos_create_date()
         return super(Sale, cls).copy(sales, default=default)
 
     @classmethod
@@ -133,8 +299,324 @@ class Sale(metaclass=PoolMeta):
             lines.append(line)
         Line.save(lines)
 
+    @classmethod
+    def add_pos_codes(cls, sale, codes):
+        """
+        Add the products of a list of (code, quantity) to the sale.
+        Codes are resolved at once, quantities of the same product are merged
+        into its existing line and all lines are saved together.
+        Returns the sale totals and the codes that could not be resolved.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Line = pool.get('sale.line')
+
+        products = Product.search_pos_codes([c for c, _ in codes])
+        lines = {}
+        for line in sale.lines:
+            if line.type == 'line' and line.product:
+                lines.setdefault(line.product.id, line)
+
+        to_save, unknown = {}, []
+        for code, quantity in codes:
+            if len(products.get(code, [])) != 1:
+                unknown.append(code)
+                continue
+            product, = products[code]
+            line = lines.get(product.id)
+            if not line:
+                line = lines[product.id] = Line.get_pos_line(
+                    sale, product, quantity)
+            else:
+                line.set_pos_quantity((line.quantity or 0) + quantity)
+            to_save[product.id] = line
+        Line.save(list(to_save.values()))
+
+        totals, = cls.read([sale.id],
+            ['untaxed_amount', 'tax_amount', 'total_amount'])
+        del totals['id']
+        totals['lines'] = [l.id for l in to_save.values()]
+        totals['unknown'] = unknown
+        return totals
+
+    def get_pos_session(self):
+        """
+        Return the POS session of the user on the sale: the last scanned
+        product and the line id of each product.
+        It is kept in memory between scans and rebuilt from the lines when it
+        has expired or has been evicted.
+        """
+        pool = Pool()
+        Config = pool.get('sale.configuration')
+        session = self._pos_session_cache.get((self.id, Transaction().user))
+        if session is None:
+            # The last line of each product is the one appended last
+            append = Config(1).pos_append_lines
+            lines = {}
+            for line in self.lines:
+                if line.type == 'line' and line.product:
+                    if append:
+                        lines[line.product.id] = line.id
+                    else:
+                        lines.setdefault(line.product.id, line.id)
+            return {'last_product': None, 'lines': lines}
+        return {
+            'last_product': session['last_product'],
+            'lines': dict(session['lines']),
+            }
+
+    def set_pos_session(self, session):
+        "Store the POS session and postpone its expiration"
+        self._pos_session_cache.set((self.id, Transaction().user), session)
+
+    def parse_pos_scan(self, value):
+        "Return the Scan of value with the barcode layouts of the shop"
+        layouts = self.shop.get_pos_barcode_layouts() if self.shop else []
+        return scan.parse(value, layouts)
+
+    def get_pos_scan(self, value, last_product=None):
+        """
+        Parse the scanned value with the barcode layouts of the shop.
+        Returns the candidate products and the Scan of the value, whose code
+        is None when the value is a quantity for last_product.
+        A bare number that is the exact code of a product is read as the code.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        value = (value or '').strip()
+        scanned = self.parse_pos_scan(value)
+        with metrics.measure('search'):
+            if scanned.code is None and scanned.quantity is not None:
+                if '*' in value:
+                    return ([last_product] if last_product else []), scanned
+                if last_product and not Product.search_pos_code(value):
+                    return [last_product], scanned
+                scanned = scan.Scan(value)
+            if scanned.code is None:
+                return [], scanned
+            return Product.search_pos_products(scanned.code), scanned
+
+    @classmethod
+    @metrics.timed('pos_scan')
+    def pos_scan(cls, sale, value, product=None):
+        """
+        Add the scanned value to the sale like the Add Products wizard but
+        keeping the state on the server.
+        value is parsed by get_pos_scan, product is the id chosen by the user
+        among the proposed products for value.
+        Returns the changed line and the sale totals or the ids of the
+        products to choose from.
+        """
+        pool = Pool()
+        Config = pool.get('sale.configuration')
+        Product = pool.get('product.product')
+        Line = pool.get('sale.line')
+
+        session = sale.get_pos_session()
+        if product is not None:
+            # The quantity or the amount of the value applies to the chosen
+            # product
+            product = Product(product)
+            scanned = sale.parse_pos_scan(value)
+            if scanned.code is None:
+                code, scanned = (value or '').strip(), scan.Scan()
+            else:
+                code = scanned.code
+            if not Product.is_pos_candidate(product, code):
+                raise UserError(gettext('sale_pos.msg_pos_scan_not_candidate',
+                        product=product.rec_name, value=value))
+            products = [product]
+        else:
+            last_product = session['last_product']
+            if last_product is not None:
+                last_product = Product(last_product)
+            products, scanned = sale.get_pos_scan(value, last_product)
+        if len(products) != 1:
+            return {'products': [p.id for p in products]}
+        product, = products
+
+        line = None
+        # In append mode only a quantity applies to the last line
+        if (not Config(1).pos_append_lines
+                or (scanned.code is None and scanned.quantity is not None)):
+            line_id = session['lines'].get(product.id)
+            if line_id:
+                line = next(iter(Line.search([
+                                ('id', '=', line_id),
+                                ('sale', '=', sale.id),
+                                ('product', '=', product.id),
+                                ])), None)
+        line = Line.add_pos_scan(sale, product, scanned, line)
+        Line.save([line])
+
+        session['last_product'] = product.id
+        session['lines'][product.id] = line.id
+        sale.set_pos_session(session)
+
+        result, = cls.read([sale.id],
+            ['untaxed_amount', 'tax_amount', 'total_amount'])
+        del result['id']
+        result['line'] = {n: getattr(line, n) for n in line._pos_scan_fields()}
+        result['line']['product'] = product.id
+        return result
+
+    @classmethod
+    @metrics.timed('edit_pos_lines')
+    def edit_pos_lines(cls, sale, changes):
+        """
+        Apply the changes to many lines of the sale and save them at once.
+        changes is a list of dictionaries with the id of the line and its new
+        quantity, unit_price or discount_rate (with sale_discount), applied in
+        this order.
+        Returns the changed lines and the sale totals.
+        """
+        pool = Pool()
+        Line = pool.get('sale.line')
+
+        line_ids = {c['id'] for c in changes}
+        lines = {l.id: l for l in Line.search([
+                    ('id', 'in', list(line_ids)),
+                    ('sale', '=', sale.id),
+                    ])}
+        if line_ids - set(lines):
+            raise UserError(gettext('sale_pos.msg_edit_pos_lines_not_in_sale',
+                    sale=sale.rec_name))
+
+        changed = []
+        for values in changes:
+            line = lines[values['id']]
+            # All the lines share the sale instance loaded once
+            line.sale = sale
+            line.set_pos_changes(values)
+            if line not in changed:
+                changed.append(line)
+        Line.save(changed)
+
+        result, = cls.read([sale.id],
+            ['untaxed_amount', 'tax_amount', 'total_amount'])
+        del result['id']
+        names = Line._pos_scan_fields()
+        result['lines'] = [{n: getattr(l, n) for n in names} for l in changed]
+        return result
+
+    @classmethod
+    def pos_metrics(cls):
+        """
+        Return the histograms of the durations in milliseconds of the POS
+        stages per shop and user recorded by the process.
+        """
+        return metrics.get()
+
+    @classmethod
+    def replay_pos_sales(cls, entries):
+        """
+        Create the sales recorded offline by a terminal.
+        Each entry is a dictionary with:
+            key: the unique key of the sale given by the terminal
+            date: the date and time the sale was recorded
+            lines: a list of (code, quantity)
+            payments: a list of (journal id, amount)
+            party and self_pick_up: optional, the defaults of the shop are
+                used otherwise
+        Entries whose key was already replayed are skipped so an entry can be
+        sent again safely.
+        Returns a dictionary with the sale id of each replayed key and the
+        unknown codes of the entries that could not be replayed.
+        """
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Product = pool.get('product.product')
+        Line = pool.get('sale.line')
+        Party = pool.get('party.party')
+        Statement = pool.get('account.statement')
+        StatementLine = pool.get('account.statement.line')
+
+        company = Transaction().context.get('company')
+        keys = [e['key'] for e in entries]
+        replayed = {s.pos_client_key: s.id for s in cls.search([
+                    ('company', '=', company),
+                    ('pos_client_key', 'in', keys),
+                    ])}
+        entries = [e for e in entries if e['key'] not in replayed]
+        products = Product.search_pos_codes(
+            [c for e in entries for c, _ in e.get('lines', [])])
+
+        defaults = cls.default_get(list(cls._fields.keys()),
+            with_rec_name=False)
+        sales, payments, unknown = [], [], {}
+        for entry in entries:
+            codes = [c for c, _ in entry.get('lines', [])
+                if len(products.get(c, [])) != 1]
+            if codes:
+                unknown[entry['key']] = codes
+                continue
+            date = entry['date']
+            if isinstance(date, str):
+                date = datetime.fromisoformat(date)
+            sale = cls(**defaults)
+            # Apply the self pick up default of the shop
+            sale.on_change_shop()
+            if entry.get('party'):
+                sale.party = Party(entry['party'])
+            sale.on_change_party()
+            if 'self_pick_up' in entry:
+                sale.self_pick_up = entry['self_pick_up']
+                sale.on_change_self_pick_up()
+            sale.sale_date = date.date()
+            sale.pos_create_date = date
+            sale.pos_client_key = entry['key']
+            sale.lines = [
+                Line.get_pos_line(sale, products[c][0], float(q))
+                for c, q in entry.get('lines', [])]
+            sales.append(sale)
+            payments.append(entry.get('payments', []))
+        cls.save(sales)
+        cls.set_number(sales)
+
+        # The payments are received now like with the payment wizard, only
+        # the sale keeps the time it was recorded
+        today = Date.today()
+        statements, statement_lines, to_end = {}, [], []
+        for sale, sale_payments in zip(
+                cls.browse([s.id for s in sales]), payments):
+            paid = _ZERO
+            for journal, amount in sale_payments:
+                if journal not in statements:
+                    statement = Statement.search([
+                            ('journal', '=', journal),
+                            ('state', '=', 'draft'),
+                            ], order=[('date', 'DESC')], limit=1)
+                    if not statement:
+                        raise UserError(gettext(
+                                'sale_pos.msg_replay_no_draft_statement',
+                                sale=sale.pos_client_key))
+                    statements[journal], = statement
+                amount = Decimal(str(amount))
+                statement_lines.append(StatementLine(
+                        statement=statements[journal],
+                        date=today,
+                        amount=amount,
+                        party=sale.party,
+                        account=sale.party.account_receivable_used,
+                        description=sale.number,
+                        sale=sale))
+                paid += amount
+            if paid == sale.total_amount:
+                to_end.append(sale)
+        StatementLine.save(statement_lines)
+        if to_end:
+            cls.workflow_to_end(to_end)
+
+        replayed.update((s.pos_client_key, s.id) for s in sales)
+        return {
+            'sales': replayed,
+            'unknown': unknown,
+            }
+
     @classmethod
     @ModelView.button
+    @metrics.timed('print')
     def print_ticket(cls, sales):
         pool = Pool()
         Config = pool.get('sale.configuration')
@@ -144,74 +626,185 @@ class Sale(metaclass=PoolMeta):
         if not config.ticket_report:
             return
 
-        for sale in sales:
-            if (not sale.ticket_number and
-                    sale.residual_amount == Decimal(0)):
-                sale.ticket_number = config.pos_sequence.get()
-                sale.save()
+        to_number = [s for s in sales if not s.ticket_number]
+        residual_amounts = {r['id']: r['residual_amount']
+            for r in cls.read([s.id for s in to_number], ['residual_amount'])}
+        to_number = [s for s in to_number
+            if residual_amounts[s.id] == Decimal(0)]
+
+        sequence_sales = defaultdict(list)
+        for sale in sorted(to_number, key=lambda s: s.id):
+            sequence_sales[sale.get_pos_sequence()].append(sale)
+        to_write = []
+        with metrics.measure('sequence'):
+            for sequence, group in sequence_sales.items():
+                numbers = sequence.get_many(len(group))
+                for sale, number in zip(group, numbers):
+                    to_write.extend(([sale], {'ticket_number': number}))
+        if to_write:
+            cls.write(*to_write)
 
         return Action(config.ticket_report.action.id).get_action_value()
 
+    @classmethod
+    def close_pos_sales(cls, sales):
+        """
+        Quote, confirm and process the paid self pick up sales and post their
+        invoices all at once.
+        Sales already processed or not paid are skipped so it can be run again
+        on the same sales.
+        """
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+
+        sales = [s for s in sales if s.self_pick_up
+            and s.state in {'draft', 'quotation', 'confirmed'}]
+        residual_amounts = {r['id']: r['residual_amount']
+            for r in cls.read([s.id for s in sales], ['residual_amount'])}
+        ids = [s.id for s in sales if residual_amounts[s.id] == Decimal(0)]
+
+        cls.quote([s for s in cls.browse(ids) if s.state == 'draft'])
+        cls.confirm([s for s in cls.browse(ids) if s.state == 'quotation'])
+        cls.process([s for s in cls.browse(ids) if s.state == 'confirmed'])
+        invoices = [i for s in cls.browse(ids) for i in s.invoices
+            if i.state in {'draft', 'validated'}]
+        Invoice.post(invoices)
+        logger.info("Closed %d sales, %d skipped", len(ids),
+            len(sales) - len(ids))
+
+    def get_pos_sequence(self):
+        """
+        Return the sequence to number the ticket.
+        Shops with their own sequence do not wait for the lock of the
+        sequence shared by the other shops of the company.
+        """
+        pool = Pool()
+        Config = pool.get('sale.configuration')
+        if self.shop and self.shop.pos_sequence:
+            return self.shop.pos_sequence
+        return Config(1).get_multivalue(
+            'pos_sequence', company=self.company.id)
+
     def create_shipment(self, shipment_type):
         if self.self_pick_up:
             return self.create_moves_without_shipment(shipment_type)
         return super(Sale, self).create_shipment(shipment_type)
 
+    @classmethod
+    def _process_shipment(cls, sales):
+        pick_up_sales = [s for s in sales if s.self_pick_up]
+        cls._create_moves_without_shipment(pick_up_sales, ['out', 'return'])
+        super()._process_shipment([s for s in sales if not s.self_pick_up])
+
     def create_moves_without_shipment(self, shipment_type):
         pool = Pool()
         Sale = pool.get('sale.sale')
-        Move = pool.get('stock.move')
 
         if not self.self_pick_up:
             return
 
-        assert self.shipment_method == 'order'
+        Sale._create_moves_without_shipment([self], [shipment_type])
+        Sale._process_invoice_shipment_states([self])
+        Sale._process_state([self])
+
+    @classmethod
+    @metrics.timed('moves')
+    def _create_moves_without_shipment(cls, sales, shipment_types):
+        """
+        Create and do at once the moves of all the lines of the self pick up
+        sales for the shipment types from the storage location of their
+        warehouse.
+        The invoice and shipment states of the sales must be processed after.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
 
+        storage_locations = {}
         to_create = []
-        for line in self.lines:
-            move = line.get_move(shipment_type)
-            if move:
-                to_create.append(move._save_values())
+        for sale in sales:
+            assert sale.self_pick_up
+            assert sale.shipment_method == 'order'
+            party = sale.shipment_party or sale.party
+            for line in sale.lines:
+                if line.type == 'line' and line.warehouse and line.quantity:
+                    # The locations are computed once per warehouse instead
+                    # of by the function fields of each line
+                    warehouse = line.warehouse
+                    if warehouse.id not in storage_locations:
+                        storage_locations[warehouse.id] = (
+                            warehouse.storage_location)
+                    storage_location = storage_locations[warehouse.id]
+                    if line.quantity >= 0:
+                        line.from_location = storage_location
+                        line.to_location = party.customer_location
+                    else:
+                        line.from_location = party.customer_location
+                        line.to_location = storage_location
+                for shipment_type in shipment_types:
+                    move = line.get_move(shipment_type)
+                    if move:
+                        to_create.append(move._save_values())
         if to_create:
             moves = Move.create(to_create)
             Move.do(moves)
 
-        Sale._process_invoice_shipment_states([self])
-        Sale._process_state([self])
-
-    @fields.depends('lines', 'currency', 'party', 'self_pick_up')
+    @fields.depends('lines', 'currency', 'self_pick_up', 'company',
+        methods=['get_tax_amount'])
     def on_change_lines(self):
         '''
-        Overrides this method completely if the sale is self pick up to improve
-        performance: Computes untaxed, total and tax amounts from the already
-        computed values in sale lines.
+        Computes the totals of self pick up sales from the already computed
+        amounts of their lines to improve performance. The taxes rounded per
+        line are the sum of the lines, otherwise they are computed for the
+        whole sale reusing the cached taxes of the unchanged lines.
         '''
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        Line = pool.get('sale.line')
+
         if not self.self_pick_up:
-            super(Sale, self).on_change_lines()
+            super().on_change_lines()
+            return
 
-        self.untaxed_amount = Decimal(0)
-        self.tax_amount = Decimal(0)
-        self.total_amount = Decimal(0)
+        config = Configuration(1)
+        line_taxes = ('amount_w_tax' in Line._fields
+            and config.get_multivalue('tax_rounding',
+                company=self.company.id if self.company else None) == 'line')
+
+        untaxed_amount = Decimal(0)
+        total_amount = Decimal(0)
+        for line in self.lines or []:
+            if line.type != 'line':
+                continue
+            untaxed_amount += getattr(line, 'amount', None) or Decimal(0)
+            if line_taxes:
+                total_amount += (
+                    getattr(line, 'amount_w_tax', None) or Decimal(0))
 
-        if self.lines:
-            self.untaxed_amount = reduce(lambda x, y: x + y,
-                [(getattr(l, 'amount', None) or Decimal(0))
-                    for l in self.lines if l.type == 'line'], Decimal(0)
-                )
-            self.total_amount = reduce(lambda x, y: x + y,
-                [(getattr(l, 'amount_w_tax', None) or Decimal(0))
-                    for l in self.lines if l.type == 'line'], Decimal(0)
-                )
         if self.currency:
-            self.untaxed_amount = self.currency.round(self.untaxed_amount)
-            self.total_amount = self.currency.round(self.total_amount)
-        self.tax_amount = self.total_amount - self.untaxed_amount
+            untaxed_amount = self.currency.round(untaxed_amount)
+        if line_taxes:
+            if self.currency:
+                total_amount = self.currency.round(total_amount)
+            tax_amount = total_amount - untaxed_amount
+        else:
+            tax_amount = Decimal(0)
+            if self.lines:
+                with Transaction().set_context(_sale_pos_price_cache=True):
+                    tax_amount = self.get_tax_amount()
+            if self.currency:
+                tax_amount = self.currency.round(tax_amount)
+            total_amount = untaxed_amount + tax_amount
         if self.currency:
-            self.tax_amount = self.currency.round(self.tax_amount)
+            total_amount = self.currency.round(total_amount)
+        self.untaxed_amount = untaxed_amount
+        self.tax_amount = tax_amount
+        self.total_amount = total_amount
 
 
 class SaleLine(metaclass=PoolMeta):
     __name__ = 'sale.line'
+    _pos_price_cache = Cache('sale.line.pos_price', context=False)
+    _pos_defaults_cache = Cache('sale.line.pos_defaults')
 
     @classmethod
     def __setup__(cls):
@@ -223,7 +816,9 @@ class SaleLine(metaclass=PoolMeta):
                 readonly = field.states['readonly']
                 del field.states['readonly']
                 field.states['readonly'] = Or(readonly, ~Eval('sale', -1))
-
+        cls.__rpc__.update({
+                'pos_price_cache_stats': RPC(),
+                })
 
     @staticmethod
     def default_sale():
@@ -231,32 +826,219 @@ class SaleLine(metaclass=PoolMeta):
             return Transaction().context.get('sale')
         return None
 
+    @classmethod
+    def get_context_sale(cls):
+        """
+        Return the sale of the context.
+        The same instance is shared by all the lines of the transaction until
+        a sale is modified.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        sale_id = Transaction().context.get('sale')
+        if not sale_id:
+            return None
+        sales = _context_sales.setdefault(Transaction(), {})
+        if sale_id not in sales:
+            sales[sale_id] = Sale(sale_id)
+        return sales[sale_id]
+
     @fields.depends('sale')
     def on_change_product(self):
-        Sale = Pool().get('sale.sale')
-
         if not self.sale:
-            sale_id = Transaction().context.get('sale')
-            if sale_id:
-                self.sale = Sale(sale_id)
+            self.sale = self.get_context_sale()
         super(SaleLine, self).on_change_product()
 
     @fields.depends('sale')
     def on_change_quantity(self):
-        Sale = Pool().get('sale.sale')
-
         if not self.sale:
-            sale_id = Transaction().context.get('sale')
-            if sale_id:
-                self.sale = Sale(sale_id)
+            self.sale = self.get_context_sale()
         super(SaleLine, self).on_change_quantity()
 
     @fields.depends('sale')
     def on_change_with_amount(self):
         if not self.sale:
-            self.sale = Transaction().context.get('sale')
+            self.sale = self.get_context_sale()
         return super(SaleLine, self).on_change_with_amount()
 
+    @classmethod
+    def get_pos_defaults(cls, sale):
+        """
+        Return the default values of a POS line of the sale.
+        They are cached with the context, the user and the party, price list
+        and company of the sale unless disabled with the line_defaults_cache
+        option.
+        """
+        fields_names = list(cls._fields.keys())
+        transaction = Transaction()
+        with transaction.set_context(sale=sale.id):
+            if not config.getboolean(
+                    'sale_pos', 'line_defaults_cache', default=True):
+                return cls.default_get(fields_names, with_rec_name=False)
+
+            key = (transaction.user,) + cls._get_pos_defaults_key(sale)
+            defaults = cls._pos_defaults_cache.get(key)
+            if defaults is None:
+                defaults = cls.default_get(fields_names, with_rec_name=False)
+                cls._pos_defaults_cache.set(key, defaults)
+        return deepcopy(defaults)
+
+    @classmethod
+    def _get_pos_defaults_key(cls, sale):
+        "Return the values of the sale the line defaults depend on"
+        price_list = getattr(sale, 'price_list', None)
+        return (
+            sale.party.id if sale.party else None,
+            price_list.id if price_list else None,
+            sale.company.id if sale.company else None,
+            )
+
+    @classmethod
+    def pos_price_cache_stats(cls):
+        "Return the hit and miss counters of the POS pricing cache"
+        return {
+            'hit': cls._pos_price_cache.hit,
+            'miss': cls._pos_price_cache.miss,
+            }
+
+    def _get_pos_price_key(self, name):
+        pool = Pool()
+        Date = pool.get('ir.date')
+        context = self._get_context_sale_price()
+        if not context.get('sale_date'):
+            context['sale_date'] = Date.today()
+        return (name, self.product.id if self.product else None,
+            abs(self.quantity or 0), freeze(context))
+
+    def compute_unit_price(self):
+        if not Transaction().context.get('_sale_pos_price_cache'):
+            return super().compute_unit_price()
+        key = self._get_pos_price_key('unit_price')
+        unit_price = self._pos_price_cache.get(key, _MISSING)
+        if unit_price is _MISSING:
+            unit_price = super().compute_unit_price()
+            self._pos_price_cache.set(key, unit_price)
+        return unit_price
+
+    def compute_taxes(self, party):
+        if not Transaction().context.get('_sale_pos_price_cache'):
+            return super().compute_taxes(party)
+        key = (self.type, self.product.id if self.product else None,
+            party.id if party else None,
+            freeze(self._get_tax_rule_pattern()),
+            Transaction().context.get('company'))
+        taxes = self._pos_price_cache.get(key)
+        if taxes is None:
+            taxes = super().compute_taxes(party)
+            self._pos_price_cache.set(key, taxes)
+        return list(taxes)
+
+    @classmethod
+    def get_pos_line(cls, sale, product, quantity):
+        """
+        Return a new line of quantity of product for the POS sale with its
+        unit price, taxes and amounts computed once.
+        """
+        line = cls(**cls.get_pos_defaults(sale))
+        line.sale = sale
+        line.company = sale.company
+        line.currency = sale.currency
+        if 'warehouse' in cls._fields:
+            line.warehouse = sale.warehouse
+        line.product = product
+        line.quantity = quantity
+        with Transaction().set_context(_sale_pos_price_cache=True):
+            line.on_change_product()
+            line._set_pos_amounts_w_tax()
+        return line
+
+    @classmethod
+    def add_pos_scan(cls, sale, product, scanned, line=None):
+        """
+        Add the Scan of product to its line, created if it is None.
+        Without code the quantity of the scan replaces the one of the line,
+        otherwise its quantity, or the quantity that costs its amount, is
+        added to the line.
+        Returns the line.
+        """
+        if scanned.code is None and scanned.quantity is not None:
+            if line:
+                line.set_pos_quantity(scanned.quantity)
+                return line
+            return cls.get_pos_line(sale, product, scanned.quantity)
+        increment = scanned.quantity if scanned.quantity is not None else 1
+        if not line:
+            line = cls.get_pos_line(sale, product, increment)
+            if scanned.amount is not None:
+                line.set_pos_quantity(line.get_pos_quantity(scanned.amount))
+            return line
+        if scanned.amount is not None:
+            increment = line.get_pos_quantity(scanned.amount)
+        line.set_pos_quantity(line.quantity + increment)
+        return line
+
+    def get_pos_quantity(self, amount):
+        """
+        Return the quantity of the line that costs amount, taxes included
+        when the line has a unit price with taxes.
+        """
+        if 'unit_price_w_tax' in self._fields:
+            price = self.unit_price_w_tax
+        else:
+            price = self.unit_price
+        if not price:
+            return 1
+        quantity = float(amount / price)
+        if self.unit:
+            quantity = self.unit.round(quantity)
+        return quantity
+
+    def set_pos_quantity(self, quantity):
+        """
+        Set the quantity of the POS line and compute once its unit price and
+        amounts.
+        """
+        self.set_pos_changes({'quantity': quantity})
+
+    def set_pos_changes(self, values):
+        """
+        Set the quantity, the unit price and the discount rate of values on
+        the POS line and compute once its amounts.
+        """
+        with Transaction().set_context(_sale_pos_price_cache=True):
+            if 'quantity' in values:
+                self.quantity = values['quantity']
+                self.on_change_quantity()
+            if 'unit_price' in values:
+                self.unit_price = values['unit_price']
+                if hasattr(self, 'on_change_unit_price'):
+                    self.on_change_unit_price()
+            if ('discount_rate' in values
+                    and hasattr(self, 'on_change_discount_rate')):
+                self.discount_rate = values['discount_rate']
+                self.on_change_discount_rate()
+            self.amount = self.on_change_with_amount()
+            self._set_pos_amounts_w_tax()
+
+    @classmethod
+    def _pos_scan_fields(cls):
+        "Return the names of the fields of the line returned by a scan"
+        names = ['id', 'quantity', 'unit_price', 'amount']
+        names.extend(n for n in ['unit_price_w_tax', 'amount_w_tax']
+            if n in cls._fields)
+        return names
+
+    def _set_pos_amounts_w_tax(self):
+        if 'unit_price_w_tax' in self._fields:
+            self.amount_w_tax = self.on_change_with_amount_w_tax()
+            key = self._get_pos_price_key('unit_price_w_tax') + (
+                self.unit_price, tuple(t.id for t in self.taxes or []))
+            unit_price_w_tax = self._pos_price_cache.get(key, _MISSING)
+            if unit_price_w_tax is _MISSING:
+                unit_price_w_tax = self.on_change_with_unit_price_w_tax()
+                self._pos_price_cache.set(key, unit_price_w_tax)
+            self.unit_price_w_tax = unit_price_w_tax
+
     def get_from_location(self, name):
         res = super(SaleLine, self).get_from_location(name)
         if self.sale.self_pick_up and self.quantity:
@@ -289,6 +1071,10 @@ class AddProductForm(ModelView):
             'sale': Eval('sale'),
             },
         depends=['sale'],)
+    line_index = fields.Dict(None, 'Line Index', readonly=True,
+        help='The position in lines of the line of each product id.')
+    line_count = fields.Integer('Line Count', readonly=True,
+        help='The number of lines indexed by the line index.')
 
 
 class ChooseProductForm(ModelView):
@@ -324,16 +1110,34 @@ class WizardAddProduct(Wizard):
 
     def default_start(self, fields):
         last_product = getattr(self.start, 'last_product', None)
+        if getattr(self.start, 'sale', None):
+            lines = self.start.lines
+        else:
+            lines = self.record.lines
         return {
             'sale': self.record.id,
-            'lines': [x.id for x in self.record.lines],
+            'lines': [x.id for x in lines],
             'last_product': last_product.id if last_product else None
             }
 
+    @cached_property
+    def changed_lines(self):
+        "The lines created or modified by the current transition"
+        return []
+
+    @metrics.timed('save')
     def add_lines(self):
-        for line in self.start.lines:
+        pool = Pool()
+        Line = pool.get('sale.line')
+
+        # New lines and the lines edited in the form of the wizard
+        to_save = [l for l in self.start.lines
+            if l.id is None or l.id < 0 or l._values]
+        to_save.extend(l for l in self.changed_lines if l not in to_save)
+        for line in to_save:
             line.sale = self.record
-            line.save()
+        Line.save(to_save)
+        del self.changed_lines
 
     def transition_pick_product_(self):
         product = self.choose.product
@@ -342,98 +1146,92 @@ class WizardAddProduct(Wizard):
         if not product and not self.choose.products:
             return 'start'
 
-        quantity = None
-        sale = self.record
-        sale_lines = sale.lines
-        lines = self.add_sale_line(sale_lines, product, quantity)
+        # The quantity or the amount of the scanned value applies to the
+        # chosen product
+        scanned = self.record.parse_pos_scan(self.start.input_value)
+        if scanned.code is None:
+            scanned = scan.Scan()
+        lines = self.add_sale_line(self.start.lines, product, scanned)
         self.start.lines = lines
         self.add_lines()
         self.start.last_product = product
         return 'start'
 
-    def _product_domain(self, value):
-         return [
-            ('salable', '=', True),
-            ['OR',
-                ('code','=', value),
-                ('identifiers.code', '=', value),
-                ('name', 'ilike', '%'+value+'%'),
-            ]]
-
+    @metrics.timed('scan')
     def transition_scan_(self):
-        pool = Pool()
-        Product = pool.get('product.product')
-
-        def qty(value):
-            try:
-                return float(value)
-            except ValueError:
-                return False
-
-        value = self.start.input_value
-        quantity = qty(value)
-
-        if (self.start.last_product and (quantity or quantity == 0.0)
-                and len(str(int(quantity))) < 5):
-            product = self.start.last_product
-        else:
-            domain = self._product_domain(value)
-            products = Product.search(domain)
-            if not products:
-                return 'start'
-
-            if len(products) > 1:
-                self.choose.products = [x.id for x in products]
-                return 'choose'
+        products, scanned = self.record.get_pos_scan(
+            self.start.input_value, self.start.last_product)
+        if not products:
+            return 'start'
 
-            product,  = products
-            # set quantity to None in case product code is numeric
-            quantity = None
-            self.start.last_product = product
+        if len(products) > 1:
+            self.choose.products = [x.id for x in products]
+            return 'choose'
 
-        lines = self.add_sale_line(self.start.lines, product, quantity)
+        product, = products
+        self.start.last_product = product
+        lines = self.add_sale_line(self.start.lines, product, scanned)
         self.start.lines = lines
         self.add_lines()
         return 'start'
 
-    def add_sale_line(self, lines, product, quantity):
+    @metrics.timed('price')
+    def add_sale_line(self, lines, product, scanned):
         pool = Pool()
+        Config = pool.get('sale.configuration')
         Line = pool.get('sale.line')
 
-        if not hasattr(self, 'lines'):
-            self.lines = ()
-        line = [x for x in lines if x.product == product]
+        config = Config(1)
+        lines = list(lines)
+        line = None
+        if not config.pos_append_lines:
+            line = self._get_product_line(lines, product)
+        elif scanned.code is None and scanned.quantity is not None:
+            # The quantity applies to the last line appended for the product
+            line = next((l for l in reversed(lines)
+                    if l.type == 'line' and l.product == product), None)
 
         sale = self.record
         if not line:
-            values = Line.default_get(
-                list(Line._fields.keys()), with_rec_name=False)
-            line = Line(**values)
-            line.sale = sale
-            line.product = product
-            line.on_change_product()
-            line.quantity = 0
-            line.company = sale.company
-            line.currency = sale.currency
-            line.on_change_quantity()
-            if 'warehouse' in Line._fields:
-                line.warehouse = sale.warehouse
-            lines += (line, )
-        else:
-            line = line[0]
-
-        if quantity:
-            line.quantity = quantity
+            line = Line.add_pos_scan(sale, product, scanned)
+            lines.append(line)
+            if self.start.line_index is not None:
+                index = dict(self.start.line_index)
+                index.setdefault(str(product.id), len(lines) - 1)
+                self.start.line_index = index
+                self.start.line_count = len(lines)
         else:
-            line.quantity += 1
-        line.unit_price = line.compute_unit_price()
-        line.amount = line.on_change_with_amount()
-        line.on_change_quantity()
-        if 'unit_price_w_tax' in Line._fields:
-            line.amount_w_tax = line.on_change_with_amount_w_tax()
-            line.unit_price_w_tax = line.on_change_with_unit_price_w_tax()
+            Line.add_pos_scan(sale, product, scanned, line)
+        self.changed_lines.append(line)
         return lines
 
+    def _get_product_line(self, lines, product):
+        "Return the line of product from lines using the line index"
+        index = self.start.line_index
+        if index is None or self.start.line_count != len(lines):
+            # Lines have been added or removed outside the wizard
+            index = self._build_line_index(lines)
+        position = index.get(str(product.id))
+        if position is not None:
+            if (position >= len(lines)
+                    or not lines[position].product
+                    or lines[position].product.id != product.id):
+                # The lines have been modified outside the wizard
+                index = self._build_line_index(lines)
+                position = index.get(str(product.id))
+        if position is not None:
+            return lines[position]
+
+    def _build_line_index(self, lines):
+        "Store and return the line index of lines"
+        index = {}
+        for position, line in enumerate(lines):
+            if line.type == 'line' and line.product:
+                index.setdefault(str(line.product.id), position)
+        self.start.line_index = index
+        self.start.line_count = len(lines)
+        return index
+
 
 class SalePaymentForm(metaclass=PoolMeta):
     __name__ = 'sale.payment.form'
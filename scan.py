@@ -0,0 +1,182 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+"""
+Parser of the values scanned or typed at the POS.
+
+The grammar is:
+
+    N          a quantity for the last product (up to 4 integer digits)
+    N* or *N   a quantity for the last product
+    N*CODE     N units of the product CODE
+    EAN-13     with a prefix of a barcode layout, the item code followed by
+               its weight, quantity or price
+    GS1        an element string with application identifiers, in the human
+               readable form with parentheses or prefixed by a symbology
+               identifier or separated by FNC1, for the GTIN (01, 02), the
+               count (30, 37), the net weight in kg (310n) and the price
+               (392n)
+    CODE       any other value is a product code
+
+The value is read once without raising exceptions.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+Scan = namedtuple('Scan', ['code', 'quantity', 'amount'])
+Scan.__new__.__defaults__ = (None, None, None)
+
+# kind is one of weight, quantity or price
+Layout = namedtuple('Layout', ['prefix', 'code_length', 'kind', 'decimals'])
+
+GS = '\x1d'
+SYMBOLOGY_IDENTIFIERS = (']C1', ']e0', ']d2', ']Q3')
+MAX_QUANTITY_DIGITS = 4
+
+# Length of the data of the application identifiers by their first 2 digits,
+# the maximum length for the variable ones
+_AI_FIXED = {
+    '00': 18, '01': 14, '02': 14, '11': 6, '12': 6, '13': 6, '15': 6,
+    '16': 6, '17': 6, '20': 2,
+    }
+_AI_VARIABLE = {
+    '10': 20, '21': 20, '22': 20, '30': 8, '37': 8, '90': 30,
+    }
+# The application identifiers of 4 digits by their first 2 digits
+_AI_4_FIXED = {'31', '32', '33', '34', '35', '36'}
+_AI_4_VARIABLE = {'39': 15}
+
+
+def _number(text):
+    "Return the float written in text or None"
+    text = text.replace(',', '.', 1)
+    unsigned = text[1:] if text.startswith('-') else text
+    integer, _, fraction = unsigned.partition('.')
+    if (not unsigned.isascii() or not integer.isdigit()
+            or (fraction and not fraction.isdigit())):
+        return None
+    return float(text)
+
+
+def _quantity(text):
+    "Return the quantity typed in text or None"
+    quantity = _number(text)
+    if quantity is not None:
+        integer = text.lstrip('-').replace(',', '.').partition('.')[0]
+        if len(integer.lstrip('0') or '0') <= MAX_QUANTITY_DIGITS:
+            return quantity
+
+
+def ean_check_digit(digits):
+    "Return the check digit of the 12 first digits of an EAN-13"
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return str((10 - total % 10) % 10)
+
+
+def _parse_embedded(value, layouts):
+    if (len(value) != 13 or not value.isdigit() or not value.isascii()
+            or ean_check_digit(value[:12]) != value[12]):
+        return None
+    for layout in sorted(layouts, key=lambda l: len(l.prefix), reverse=True):
+        if not value.startswith(layout.prefix):
+            continue
+        start = len(layout.prefix)
+        end = start + layout.code_length
+        code, digits = value[start:end], value[end:12]
+        if not code or not digits:
+            continue
+        number = int(digits)
+        if layout.kind == 'price':
+            return Scan(code, amount=Decimal(number).scaleb(-layout.decimals))
+        return Scan(code, quantity=number / 10 ** layout.decimals)
+
+
+def _gs1_elements(value):
+    "Yield the (identifier, data) of the GS1 element string"
+    if value.startswith('('):
+        i = 0
+        while i < len(value) and value[i] == '(':
+            end = value.find(')', i)
+            if end < 0:
+                return
+            ai = value[i + 1:end]
+            following = value.find('(', end)
+            if following < 0:
+                following = len(value)
+            yield ai, value[end + 1:following]
+            i = following
+        return
+
+    i = 0
+    while i < len(value):
+        if value[i] == GS:
+            i += 1
+            continue
+        head = value[i:i + 2]
+        if head in _AI_FIXED:
+            ai, length, variable = head, _AI_FIXED[head], False
+        elif head in _AI_VARIABLE:
+            ai, length, variable = head, _AI_VARIABLE[head], True
+        elif head in _AI_4_FIXED:
+            ai, length, variable = value[i:i + 4], 6, False
+        elif head in _AI_4_VARIABLE:
+            ai, length, variable = value[i:i + 4], _AI_4_VARIABLE[head], True
+        else:
+            return
+        start = i + len(ai)
+        end = start + length
+        if variable:
+            separator = value.find(GS, start, end)
+            if separator >= 0:
+                end = separator
+        yield ai, value[start:end]
+        i = end
+
+
+def _parse_gs1(value):
+    code = quantity = amount = None
+    for ai, data in _gs1_elements(value):
+        if not data.isdigit() or not data.isascii():
+            continue
+        if ai in {'01', '02'} and len(data) == 14:
+            # Identify by the EAN-13 when the GTIN-14 has no indicator
+            code = data[1:] if data.startswith('0') else data
+        elif ai in {'30', '37'}:
+            quantity = float(int(data))
+        elif len(ai) == 4 and ai.startswith('310') and ai[3].isdigit():
+            quantity = int(data) / 10 ** int(ai[3])
+        elif len(ai) == 4 and ai.startswith('392') and ai[3].isdigit():
+            amount = Decimal(int(data)).scaleb(-int(ai[3]))
+    return Scan(code, quantity, amount)
+
+
+def parse(value, layouts=()):
+    "Return the Scan of the value using the embedded barcode layouts"
+    value = (value or '').strip()
+    if not value:
+        return Scan()
+
+    for identifier in SYMBOLOGY_IDENTIFIERS:
+        if value.startswith(identifier):
+            return _parse_gs1(value[len(identifier):])
+    if value.startswith('(0') or GS in value:
+        return _parse_gs1(value)
+
+    multiplier, star, code = value.partition('*')
+    if star:
+        if not multiplier:
+            return Scan(quantity=_number(code))
+        quantity = _number(multiplier)
+        if quantity is None:
+            return Scan(value)
+        if not code:
+            return Scan(quantity=quantity)
+        return Scan(code, quantity)
+
+    embedded = _parse_embedded(value, layouts)
+    if embedded:
+        return embedded
+
+    quantity = _quantity(value)
+    if quantity is not None:
+        return Scan(quantity=quantity)
+    return Scan(value)
@@ -1,11 +1,24 @@
 #This file is part sale_shop module for Tryton.
 #The COPYRIGHT file at the top level of this repository contains
 #the full copyright notices and license terms.
-from trytond.model import fields
-from trytond.pool import PoolMeta
-from trytond.pyson import Eval
+import logging
+from datetime import datetime, time, timedelta
 
-__all__ = ['SaleShop']
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.i18n import gettext
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.model.exceptions import ValidationError
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, Id
+from trytond.tools import grouped_slice
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+from . import scan
+
+__all__ = ['SaleShop', 'BarcodeLayout', 'CloseDayStart', 'CloseDay']
+
+logger = logging.getLogger(__name__)
 
 
 class SaleShop(metaclass=PoolMeta):
@@ -17,3 +30,163 @@ class SaleShop(metaclass=PoolMeta):
     self_pick_up = fields.Boolean('Default Self Pick Up',
         help='The goods are picked up by the customer before the sale, so no '
         'shipment is created.')
+    pos_sequence = fields.Many2One('ir.sequence.strict', "Ticket Sequence",
+        domain=[
+            ('company', 'in', [Eval('company', -1), None]),
+            ('sequence_type', '=', Id('sale_pos', 'sequence_type_sale_pos')),
+            ], depends=['company'],
+        help="The sequence used to number the tickets of the shop.\n"
+        "Leave empty to use the sequence of the sale configuration.")
+    pos_barcode_layouts = fields.One2Many('sale_pos.barcode_layout', 'shop',
+        "Barcode Layouts",
+        help="The layouts of the barcodes with an embedded weight, quantity "
+        "or price printed by the scales of the shop.")
+    _pos_barcode_layouts_cache = Cache(
+        'sale.shop.pos_barcode_layouts', context=False)
+
+    @classmethod
+    def on_modification(cls, mode, shops, field_names=None):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        super().on_modification(mode, shops, field_names=field_names)
+        Sale.clear_pos_context()
+
+    def get_pos_barcode_layouts(self):
+        "Return the barcode layouts of the shop to parse the scanned values"
+        layouts = self._pos_barcode_layouts_cache.get(self.id)
+        if layouts is None:
+            layouts = [
+                (l.prefix, l.code_length, l.kind, l.decimals)
+                for l in self.pos_barcode_layouts]
+            self._pos_barcode_layouts_cache.set(self.id, layouts)
+        return [scan.Layout(*l) for l in layouts]
+
+    @classmethod
+    def close_pos_day(cls, shops, date):
+        """
+        Close the self pick up sales of the shops created at the POS on the
+        date by chunks.
+        Each chunk is processed by a queued task in its own transaction, so
+        the closing can be run again after a failure to close the remaining
+        sales.
+        Returns the number of sales to close.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        start = datetime.combine(date, time())
+        sales = Sale.search([
+                ('shop', 'in', [s.id for s in shops]),
+                ('pos_create_date', '>=', start),
+                ('pos_create_date', '<', start + timedelta(days=1)),
+                ('self_pick_up', '=', True),
+                ('state', 'in', ['draft', 'quotation', 'confirmed']),
+                ], order=[('id', 'ASC')])
+        size = config.getint('sale_pos', 'day_close_chunk', default=100)
+        chunks = 0
+        for sub_sales in grouped_slice(sales, size):
+            Sale.__queue__.close_pos_sales(list(sub_sales))
+            chunks += 1
+        logger.info("Closing %d sales of %s on %s in %d chunks",
+            len(sales), ', '.join(s.rec_name for s in shops), date, chunks)
+        return len(sales)
+
+
+class BarcodeLayout(ModelSQL, ModelView):
+    "Barcode Layout"
+    __name__ = 'sale_pos.barcode_layout'
+    _rec_name = 'prefix'
+    shop = fields.Many2One('sale.shop', "Shop", required=True,
+        ondelete='CASCADE')
+    prefix = fields.Char("Prefix", required=True, size=3,
+        help="The digits that start the EAN-13 barcodes of the layout, "
+        "usually from 20 to 29.")
+    code_length = fields.Integer("Code Length", required=True,
+        domain=[('code_length', '>', 0)],
+        help="The number of digits of the product code after the prefix.\n"
+        "The following digits up to the check digit are the value.")
+    kind = fields.Selection([
+            ('weight', "Weight"),
+            ('quantity', "Quantity"),
+            ('price', "Price"),
+            ], "Kind", required=True,
+        help="Weight and quantity set the quantity of the line, price sets "
+        "the quantity of the line that costs the amount.")
+    decimals = fields.Integer("Decimals", required=True,
+        domain=[('decimals', '>=', 0)],
+        help="The number of decimals of the value.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('prefix', 'ASC'))
+
+    @staticmethod
+    def default_code_length():
+        return 5
+
+    @staticmethod
+    def default_kind():
+        return 'weight'
+
+    @staticmethod
+    def default_decimals():
+        return 3
+
+    @fields.depends('kind')
+    def on_change_kind(self):
+        if self.kind == 'price':
+            self.decimals = 2
+        elif self.kind == 'weight':
+            self.decimals = 3
+        elif self.kind == 'quantity':
+            self.decimals = 0
+
+    @classmethod
+    def on_modification(cls, mode, layouts, field_names=None):
+        pool = Pool()
+        Shop = pool.get('sale.shop')
+        super().on_modification(mode, layouts, field_names=field_names)
+        Shop._pos_barcode_layouts_cache.clear()
+
+    @classmethod
+    def validate_fields(cls, layouts, field_names):
+        super().validate_fields(layouts, field_names)
+        if field_names & {'prefix', 'code_length'}:
+            for layout in layouts:
+                layout.check_layout()
+
+    def check_layout(self):
+        # The value needs at least one digit before the check digit
+        if (not self.prefix.isdigit() or not self.prefix.isascii()
+                or len(self.prefix) + self.code_length >= 12):
+            raise ValidationError(gettext(
+                    'sale_pos.msg_barcode_layout_invalid',
+                    layout=self.rec_name))
+
+
+class CloseDayStart(ModelView):
+    "Close POS Day"
+    __name__ = 'sale_pos.close_day.start'
+    date = fields.Date("Date", required=True,
+        help="The day the self pick up sales to close were created.")
+
+    @staticmethod
+    def default_date():
+        Date = Pool().get('ir.date')
+        return Date.today()
+
+
+class CloseDay(Wizard):
+    "Close POS Day"
+    __name__ = 'sale_pos.close_day'
+    start = StateView('sale_pos.close_day.start',
+        'sale_pos.close_day_start_view_form', [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Close", 'close', 'tryton-ok', default=True),
+            ])
+    close = StateTransition()
+
+    def transition_close(self):
+        self.model.close_pos_day(self.records, self.start.date)
+        return 'end'
@@ -0,0 +1,516 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Performance benchmarks of the sale_pos module.
+
+They run through proteus against the database configured by the
+TRYTOND_DATABASE_URI and DB_NAME environment variables like the scenarios,
+SQLite or PostgreSQL, and the results can be written as JSON to compare
+releases:
+
+    python -m trytond.modules.sale_pos.tests.benchmark ticket_growth \
+        --output ticket_growth.json
+"""
+import argparse
+import inspect
+import json
+import random
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from proteus import Model, Wizard
+from trytond import __version__, backend
+from trytond.modules.account.tests.tools import (
+    create_chart, create_fiscalyear, create_tax, get_accounts)
+from trytond.modules.account_invoice.tests.tools import (
+    create_payment_term, set_fiscalyear_invoice_sequences)
+from trytond.modules.company.tests.tools import create_company, get_company
+from trytond.modules.sale_shop.tests.tools import create_shop
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME
+from trytond.tests.tools import activate_modules
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+
+def setup(products=100):
+    "Activate sale_pos and create a shop with salable products"
+    config = activate_modules('sale_pos')
+
+    _ = create_company()
+    company = get_company()
+    fiscalyear = set_fiscalyear_invoice_sequences(create_fiscalyear(company))
+    fiscalyear.click('create_period')
+    _ = create_chart(company)
+    accounts = get_accounts(company)
+
+    tax = create_tax(Decimal('.10'))
+    tax.save()
+
+    Party = Model.get('party.party')
+    customer = Party(name='Customer')
+    customer.account_receivable = accounts['receivable']
+    customer.save()
+
+    ProductCategory = Model.get('product.category')
+    account_category = ProductCategory(name='Category')
+    account_category.accounting = True
+    account_category.account_expense = accounts['expense']
+    account_category.account_revenue = accounts['revenue']
+    account_category.customer_taxes.append(tax)
+    account_category.save()
+
+    ProductUom = Model.get('product.uom')
+    unit, = ProductUom.find([('name', '=', 'Unit')])
+    create_products(config, products, unit, account_category)
+
+    payment_term = create_payment_term()
+    payment_term.save()
+
+    PriceList = Model.get('product.price_list')
+    price_list = PriceList(name='Default', price='list_price')
+    price_list_line = price_list.lines.new()
+    price_list_line.formula = 'unit_price'
+    price_list.save()
+
+    shop = create_shop(payment_term, price_list)
+    shop.party = customer
+    shop.sale_invoice_method = 'order'
+    shop.self_pick_up = True
+    shop.save()
+
+    User = Model.get('res.user')
+    user, = User.find([('login', '=', 'admin')])
+    user.shops.append(shop)
+    user.shop = shop
+    user.save()
+    config._context = User.get_preferences(True, config.context)
+    return config
+
+
+def setup_statement(config):
+    "Create a device with a statement journal and open its statement"
+    accounts = get_accounts(get_company())
+    Journal = Model.get('account.journal')
+    StatementJournal = Model.get('account.statement.journal')
+    account_journal = Journal(name='Statement', type='statement')
+    account_journal.save()
+    statement_journal = StatementJournal(name='Default',
+        journal=account_journal, account=accounts['cash'],
+        validation='balance')
+    statement_journal.save()
+
+    User = Model.get('res.user')
+    user, = User.find([('login', '=', 'admin')])
+    Device = Model.get('sale.device')
+    device = Device(name='Default', shop=user.shop)
+    device.journals.append(statement_journal)
+    device.journal = statement_journal
+    device.save()
+    user.sale_device = device
+    user.save()
+    config._context = User.get_preferences(True, config.context)
+
+    Wizard('open.statement').execute('create_')
+    Statement = Model.get('account.statement')
+    statement, = Statement.find([('state', '=', 'draft')])
+    return statement
+
+
+def percentile(values, p):
+    "Return the p percentile of values"
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def product_code(i):
+    return 'P%07d' % i
+
+
+def product_identifier(i):
+    return '84%011d' % i
+
+
+def create_products(config, count, unit, account_category):
+    "Create count products with a code and an identifier in batches"
+    Template = Model.get('product.template')
+    for sub_range in grouped_slice(range(count), 1000):
+        Template._proxy.create([{
+                    'name': 'Product %s' % i,
+                    'default_uom': unit.id,
+                    'type': 'goods',
+                    'salable': True,
+                    'list_price': Decimal(i % 100 + 1),
+                    'account_category': account_category.id,
+                    'products': [('create', [{
+                                    'suffix_code': product_code(i),
+                                    'identifiers': [('create', [{
+                                                    'code': (
+                                                        product_identifier(i)),
+                                                    }])],
+                                    }])],
+                    } for i in sub_range], config.context)
+
+
+def scan(wizard, value):
+    "Scan value in the add product wizard and return the elapsed seconds"
+    wizard.form.input_value = value
+    start = time.perf_counter()
+    wizard.execute('scan_')
+    return time.perf_counter() - start
+
+
+def ticket_growth(lines=500, step=50):
+    """
+    Scan lines different products in one ticket and return the mean scan
+    latency for each step of lines.
+    """
+    setup(products=lines)
+    Sale = Model.get('sale.sale')
+    sale = Sale()
+    sale.save()
+    wizard = Wizard('sale_pos.add_product', [sale])
+    result = []
+    timings = []
+    for i in range(lines):
+        timings.append(scan(wizard, product_code(i)))
+        if len(timings) == step:
+            result.append({
+                    'lines': i + 1,
+                    'mean': sum(timings) / len(timings),
+                    })
+            timings = []
+    return result
+
+
+def scan_rate(products=10000, scans=1000, basket=20, seed=0):
+    """
+    Scan random codes and identifiers of a catalog of products in tickets of
+    basket lines and return the scans per second and their latency.
+    """
+    setup(products=products)
+    Sale = Model.get('sale.sale')
+    rng = random.Random(seed)
+    timings = []
+    wizard = None
+    for i in range(scans):
+        if not i % basket:
+            sale = Sale()
+            sale.save()
+            wizard = Wizard('sale_pos.add_product', [sale])
+        j = rng.randrange(products)
+        value = product_code(j) if rng.random() < .5 else product_identifier(j)
+        timings.append(scan(wizard, value))
+    return [{
+            'products': products,
+            'scans': scans,
+            'scans_per_second': len(timings) / sum(timings),
+            'p50': percentile(timings, 50),
+            'p99': percentile(timings, 99),
+            }]
+
+
+def on_change_lines(lines=500, step=50, repeat=20):
+    """
+    Return the mean duration of Sale.on_change_lines for a sale with a
+    growing number of lines, self pick up or not.
+    """
+    config = setup(products=lines)
+    result = []
+    with Transaction().start(DB_NAME, config.user, context=config.context):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+        Product = pool.get('product.product')
+        products = Product.search([], order=[('id', 'ASC')], limit=lines)
+        for self_pick_up in [True, False]:
+            sale = Sale(**Sale.default_get(
+                    list(Sale._fields.keys()), with_rec_name=False))
+            sale.self_pick_up = self_pick_up
+            sale_lines = []
+            for i, product in enumerate(products, 1):
+                sale_lines.append(Line.get_pos_line(sale, product, 1))
+                if i % step:
+                    continue
+                sale.lines = sale_lines
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    sale.on_change_lines()
+                result.append({
+                        'self_pick_up': self_pick_up,
+                        'lines': i,
+                        'mean': (time.perf_counter() - start) / repeat,
+                        })
+    return result
+
+
+def day_close(sales=1000, chunk=100):
+    """
+    Close paid self pick up sales of one line by chunks and return the sales
+    closed per second.
+    """
+    config = setup(products=1)
+    statement = setup_statement(config)
+    Product = Model.get('product.product')
+    product, = Product.find([])
+
+    with Transaction().start(
+            DB_NAME, config.user, context=config.context) as transaction:
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Sale = pool.get('sale.sale')
+        StatementLine = pool.get('account.statement.line')
+        today = Date.today()
+        sale_ids = Sale.import_pos_sales({
+                'self_pick_up': True,
+                'invoice_method': 'order',
+                'shipment_method': 'order',
+                'lines': [('create', [{
+                                'product': product.id,
+                                'unit': product.default_uom.id,
+                                'quantity': 1,
+                                'unit_price': product.list_price,
+                                }])],
+                } for _ in range(sales))
+        StatementLine.save([StatementLine(
+                    statement=statement.id,
+                    date=today,
+                    amount=sale.total_amount,
+                    party=sale.party,
+                    account=sale.party.account_receivable_used,
+                    sale=sale)
+                for sale in Sale.browse(sale_ids)])
+        transaction.commit()
+
+    timings = []
+    for sub_ids in grouped_slice(sale_ids, chunk):
+        sub_ids = list(sub_ids)
+        with Transaction().start(
+                DB_NAME, config.user, context=config.context) as transaction:
+            Sale = Pool().get('sale.sale')
+            start = time.perf_counter()
+            Sale.close_pos_sales(Sale.browse(sub_ids))
+            transaction.commit()
+            timings.append(time.perf_counter() - start)
+    return [{
+            'sales': sales,
+            'chunk': chunk,
+            'sales_per_second': sales / sum(timings),
+            'chunk_p50': percentile(timings, 50),
+            'chunk_max': max(timings),
+            }]
+
+
+def run_tills(func, tills, calls, user, context):
+    """
+    Call calls times func(till, call, transaction) from a thread for each
+    till, each call in its own transaction and retried with the same call
+    number until it is committed.
+    Returns the elapsed seconds of each call and the number of retries due
+    to lock or serialization errors.
+    """
+    timings, retries = [], []
+
+    def till(i):
+        for call in range(calls):
+            while True:
+                start = time.perf_counter()
+                try:
+                    with Transaction().start(
+                            DB_NAME, user, context=context) as transaction:
+                        func(i, call, transaction)
+                        transaction.commit()
+                except backend.DatabaseOperationalError:
+                    retries.append(i)
+                    continue
+                timings.append(time.perf_counter() - start)
+                break
+
+    threads = [threading.Thread(target=till, args=(i,))
+        for i in range(tills)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, len(retries)
+
+
+def ticket_numbering(tills=8, tickets=50, shops=2, hold=0.01):
+    """
+    Print the tickets of paid sales from concurrent tills split over shops
+    numbering with the sequence of the configuration and then with a
+    sequence per shop.
+    hold is the seconds each till keeps its transaction open after printing,
+    like a client saving the sale in the same request.
+    Concurrency is only meaningful on PostgreSQL.
+    """
+    config = setup(products=1)
+    Config = Model.get('sale.configuration')
+    ActionReport = Model.get('ir.action.report')
+    Sequence = Model.get('ir.sequence.strict')
+    Shop = Model.get('sale.shop')
+    sale_config = Config(1)
+    sale_config.ticket_report, = ActionReport.find([
+            ('report_name', '=', 'sale.sale'),
+            ])
+    sale_config.save()
+
+    shop, = Shop.find([])
+    all_shops = [shop]
+    for i in range(1, shops):
+        other = create_shop(shop.payment_term, shop.price_list)
+        other.name = 'Shop %s' % i
+        other.party = shop.party
+        other.self_pick_up = True
+        other.save()
+        all_shops.append(other)
+    shared = sale_config.pos_sequence
+
+    result = []
+    for mode in ['configuration', 'shop']:
+        for i, shop in enumerate(all_shops):
+            if mode == 'shop':
+                shop.pos_sequence = Sequence(name='Shop %s' % i,
+                    sequence_type=shared.sequence_type,
+                    company=shared.company)
+                shop.pos_sequence.save()
+            else:
+                shop.pos_sequence = None
+            shop.save()
+
+        # Sales without lines are paid so their ticket is numbered
+        with Transaction().start(
+                DB_NAME, config.user, context=config.context) as transaction:
+            Sale = Pool().get('sale.sale')
+            sales = [[s.id for s in Sale.create([{
+                                'shop': all_shops[i % shops].id,
+                                'party': all_shops[i % shops].party.id,
+                                } for _ in range(tickets)])]
+                for i in range(tills)]
+            transaction.commit()
+
+        def print_ticket(i, call, transaction):
+            Sale = Pool().get('sale.sale')
+            Sale.print_ticket(Sale.browse([sales[i][call]]))
+            time.sleep(hold)
+
+        start = time.perf_counter()
+        timings, retries = run_tills(
+            print_ticket, tills, tickets, config.user, config.context)
+        elapsed = time.perf_counter() - start
+        result.append({
+                'mode': mode,
+                'tills': tills,
+                'shops': shops,
+                'tickets_per_second': len(timings) / elapsed,
+                'mean': sum(timings) / len(timings),
+                'max': max(timings),
+                'retries': retries,
+                })
+    return result
+
+
+def sale_import(sales=100000):
+    """
+    Create sales with one line from a generator of values and return the
+    peak of memory allocated and the elapsed seconds for Sale.create with all
+    the values at once and for Sale.import_pos_sales by batches.
+    Each is run with values that have their POS create date and with values
+    that get it from Sale.create.
+    """
+    config = setup(products=1)
+    Product = Model.get('product.product')
+    product, = Product.find([])
+    Party = Model.get('party.party')
+    customer, = Party.find([('name', '=', 'Customer')])
+    start_date = datetime(2024, 1, 1)
+
+    def values(dated):
+        for i in range(sales):
+            value = {
+                'party': customer.id,
+                'self_pick_up': True,
+                'lines': [('create', [{
+                                'product': product.id,
+                                'unit': product.default_uom.id,
+                                'quantity': 1,
+                                'unit_price': product.list_price,
+                                }])],
+                }
+            if dated:
+                value['pos_create_date'] = start_date + timedelta(seconds=i)
+            yield value
+
+    result = []
+    for mode in ['create', 'import']:
+        for dated in [True, False]:
+            with Transaction().start(DB_NAME, config.user,
+                    context=config.context) as transaction:
+                Sale = Pool().get('sale.sale')
+                tracemalloc.start()
+                start = time.perf_counter()
+                if mode == 'create':
+                    Sale.create(list(values(dated)))
+                else:
+                    Sale.import_pos_sales(values(dated))
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                transaction.rollback()
+            result.append({
+                    'mode': mode,
+                    'dated': dated,
+                    'sales': sales,
+                    'peak_mib': peak / 2 ** 20,
+                    'seconds': elapsed,
+                    })
+    return result
+
+
+BENCHMARKS = {
+    'scan_rate': scan_rate,
+    'ticket_growth': ticket_growth,
+    'on_change_lines': on_change_lines,
+    'day_close': day_close,
+    'ticket_numbering': ticket_numbering,
+    'sale_import': sale_import,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--products', type=int)
+    parser.add_argument('--scans', type=int)
+    parser.add_argument('--lines', type=int)
+    parser.add_argument('--tills', type=int)
+    parser.add_argument('--tickets', type=int)
+    parser.add_argument('--shops', type=int)
+    parser.add_argument('--sales', type=int)
+    parser.add_argument('--output', metavar='FILE',
+        help="write the results as JSON to FILE")
+    args = parser.parse_args()
+    func = BENCHMARKS[args.benchmark]
+    parameters = inspect.signature(func).parameters
+    kwargs = {k: v for k, v in vars(args).items()
+        if k in parameters and v is not None}
+    rows = func(**kwargs)
+    for row in rows:
+        print(', '.join('%s: %s' % i for i in row.items()))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                    'benchmark': args.benchmark,
+                    'parameters': kwargs,
+                    'backend': backend.name,
+                    'trytond': __version__,
+                    'date': datetime.now().isoformat(),
+                    'results': rows,
+                    }, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
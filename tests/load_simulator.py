@@ -0,0 +1,193 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""
+Load simulator of concurrent POS terminals.
+
+Each terminal runs in its own thread and sells tickets through the Add
+Products wizard, the payment wizard and the ticket printing, each call in its
+own transaction, against the database configured by the TRYTOND_DATABASE_URI
+and DB_NAME environment variables:
+
+    python -m trytond.modules.sale_pos.tests.load_simulator --tills 8
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+
+from proteus import Model, Wizard
+from trytond import backend
+from trytond.modules.sale_pos.tests.benchmark import (
+    percentile, product_code, product_identifier, setup, setup_statement)
+from trytond.tests.test_tryton import DB_NAME
+from trytond.transaction import Transaction
+
+# The PostgreSQL errors of concurrent transactions
+FAILURES = {
+    '40001': 'serialization_failure',
+    '40P01': 'deadlock_detected',
+    '55P03': 'lock_not_available',
+    }
+
+
+class Terminal(threading.Thread):
+    "A till selling tickets of random baskets"
+
+    def __init__(self, simulator, number):
+        super().__init__(name='till-%s' % number)
+        self.simulator = simulator
+        self.rng = random.Random(simulator.seed + number)
+
+    def call(self, operation, func, *args):
+        "Call func until it succeeds and record its latency and failures"
+        while True:
+            start = time.perf_counter()
+            try:
+                result = func(*args)
+            except backend.DatabaseOperationalError as exception:
+                code = getattr(exception, 'pgcode', None)
+                self.simulator.failure(FAILURES.get(code, code or 'other'))
+                time.sleep(self.rng.uniform(0, .05))
+                continue
+            self.simulator.timing(operation, time.perf_counter() - start)
+            return result
+
+    def basket_size(self):
+        "Return a number of items with a log-normal distribution"
+        sigma = .8
+        mu = math.log(self.simulator.basket) - sigma ** 2 / 2
+        return max(1, round(self.rng.lognormvariate(mu, sigma)))
+
+    def scan_value(self):
+        product = self.rng.randrange(self.simulator.products)
+        if self.rng.random() < .5:
+            return product_code(product)
+        return product_identifier(product)
+
+    def run(self):
+        config = self.simulator.config
+        Sale = Model.get('sale.sale', config=config)
+        for _ in range(self.simulator.tickets):
+            sale = Sale()
+            self.call('create', sale.save)
+            wizard = Wizard('sale_pos.add_product', [sale], config=config)
+            for _ in range(self.basket_size()):
+                wizard.form.input_value = self.scan_value()
+                self.call('scan', wizard.execute, 'scan_')
+            wizard.execute('end')
+
+            payment = Wizard('sale.payment', [sale], config=config)
+            self.call('pay', payment.execute, 'pay_')
+            self.call('print', sale.click, 'print_ticket')
+            self.simulator.ticket()
+
+
+class LockMonitor(threading.Thread):
+    "Sample the backends of the database waiting for a lock"
+
+    def __init__(self, interval=.05):
+        super().__init__(name='lock-monitor', daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with Transaction().start(DB_NAME, 0, readonly=True) as transaction:
+                cursor = transaction.connection.cursor()
+                cursor.execute("SELECT COUNT(*) FROM pg_stat_activity "
+                    "WHERE datname = current_database() "
+                    "AND wait_event_type = 'Lock'")
+                self.samples.append(cursor.fetchone()[0])
+
+
+class Simulator:
+
+    def __init__(self, tills=8, tickets=20, basket=8, products=1000, seed=0):
+        self.tills = tills
+        self.tickets = tickets
+        self.basket = basket
+        self.products = products
+        self.seed = seed
+        self._lock = threading.Lock()
+        self.timings = defaultdict(list)
+        self.failures = Counter()
+        self.tickets_sold = 0
+
+    def timing(self, operation, duration):
+        with self._lock:
+            self.timings[operation].append(duration)
+
+    def failure(self, name):
+        with self._lock:
+            self.failures[name] += 1
+
+    def ticket(self):
+        with self._lock:
+            self.tickets_sold += 1
+
+    def run(self):
+        self.config = setup(products=self.products)
+        setup_statement(self.config)
+
+        monitor = None
+        if backend.name == 'postgresql':
+            monitor = LockMonitor()
+            monitor.start()
+        terminals = [Terminal(self, i) for i in range(self.tills)]
+        start = time.perf_counter()
+        for terminal in terminals:
+            terminal.start()
+        for terminal in terminals:
+            terminal.join()
+        elapsed = time.perf_counter() - start
+        if monitor:
+            monitor.stopped.set()
+            monitor.join()
+
+        report = {
+            'tills': self.tills,
+            'tickets': self.tickets_sold,
+            'tickets_per_second': self.tickets_sold / elapsed,
+            'operations': {
+                name: {
+                    'count': len(timings),
+                    'per_second': len(timings) / elapsed,
+                    'p50': percentile(timings, 50),
+                    'p99': percentile(timings, 99),
+                    } for name, timings in self.timings.items()},
+            'failures': dict(self.failures),
+            }
+        if monitor and monitor.samples:
+            report['lock_waits'] = {
+                'mean': sum(monitor.samples) / len(monitor.samples),
+                'max': max(monitor.samples),
+                }
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tills', type=int, default=8)
+    parser.add_argument('--tickets', type=int, default=20,
+        help="the number of tickets sold by each till")
+    parser.add_argument('--basket', type=float, default=8,
+        help="the mean number of items of a ticket")
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='FILE',
+        help="write the report as JSON to FILE")
+    args = parser.parse_args()
+    report = Simulator(tills=args.tills, tickets=args.tickets,
+        basket=args.basket, products=args.products, seed=args.seed).run()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,23 @@
 
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import os
+import random
+import tempfile
+from decimal import Decimal
+from unittest.mock import patch
 
+from sql import Null
+
+from trytond.config import config
+from trytond.modules.account.tests import create_chart
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.sale_pos import metrics, scan
+from trytond.modules.sale_pos.journal import PosJournal
 from trytond.modules.sale_shop.tests import SaleShopCompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
 
 
 class SalePosTestCase(SaleShopCompanyTestMixin, ModuleTestCase):
@@ -12,5 +26,517 @@ class SalePosTestCase(SaleShopCompanyTestMixin, ModuleTestCase):
     extras = ['sale_payment_type', 'sale_shipment_cost', 'sale_margin',
         'commission', 'sale_discount', 'discount_formula']
 
+    def create_products(self, company, prices, **values):
+        "Create a salable product with the tax of the chart for each price"
+        pool = Pool()
+        Account = pool.get('account.account')
+        Tax = pool.get('account.tax')
+        Category = pool.get('product.category')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        create_chart(company, tax=True)
+        tax, = Tax.search([])
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        expense, = Account.search([
+                ('type.expense', '=', True),
+                ('closed', '!=', True),
+                ], limit=1)
+        category = Category(name='Category', accounting=True,
+            account_revenue=revenue, account_expense=expense,
+            customer_taxes=[tax])
+        category.save()
+        unit, = Uom.search([('name', '=', 'Unit')])
+        templates = Template.create([{
+                    'name': 'Product %s' % i,
+                    'default_uom': unit.id,
+                    'type': 'goods',
+                    'salable': True,
+                    'list_price': price,
+                    'account_category': category.id,
+                    'products': [('create', [values])],
+                    } for i, price in enumerate(prices)])
+        return [p for t in templates for p in t.products]
+
+    def create_shop(self, company):
+        "Return a new shop of the company with its price list"
+        pool = Pool()
+        Configuration = pool.get('sale.configuration')
+        Location = pool.get('stock.location')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        PaymentTermLine = pool.get('account.invoice.payment_term.line')
+        PriceList = pool.get('product.price_list')
+        PriceListLine = pool.get('product.price_list.line')
+        Shop = pool.get('sale.shop')
+
+        warehouse, = Location.search([('type', '=', 'warehouse')])
+        payment_term = PaymentTerm(name='Term',
+            lines=[PaymentTermLine(type='remainder')])
+        payment_term.save()
+        price_list = PriceList(name='Default', price='list_price',
+            lines=[PriceListLine(formula='unit_price')])
+        price_list.save()
+        shop = Shop(name='Shop', warehouse=warehouse, price_list=price_list,
+            payment_term=payment_term,
+            sale_sequence=Configuration(1).get_multivalue(
+                'sale_sequence', company=company.id),
+            sale_invoice_method='order', sale_shipment_method='order')
+        shop.save()
+        return shop
+
+    def pos_sale(self, company):
+        "Return a new sale of the company for a new party"
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+        party = Party(name='Customer')
+        party.save()
+        return Sale(company=company, currency=company.currency,
+            party=party, invoice_party=None, sale_date=None, warehouse=None)
+
+    @with_transaction()
+    def test_pos_line_pricing(self):
+        'Test POS line pricing matches the on_change chain'
+        pool = Pool()
+        Line = pool.get('sale.line')
+
+        def on_change_chain(sale, product, quantity):
+            line = Line(**Line.default_get(
+                    list(Line._fields.keys()), with_rec_name=False))
+            line.sale = sale
+            line.product = product
+            line.on_change_product()
+            line.quantity = 0
+            line.company = sale.company
+            line.currency = sale.currency
+            line.on_change_quantity()
+            line.warehouse = sale.warehouse
+            line.quantity = quantity
+            line.unit_price = line.compute_unit_price()
+            line.amount = line.on_change_with_amount()
+            line.on_change_quantity()
+            line.amount_w_tax = line.on_change_with_amount_w_tax()
+            line.unit_price_w_tax = line.on_change_with_unit_price_w_tax()
+            return line
+
+        company = create_company()
+        with set_company(company):
+            rng = random.Random(42)
+            products = self.create_products(company, [
+                    Decimal(rng.randint(1, 1000000)) / 10000
+                    for _ in range(20)])
+            sale = self.pos_sale(company)
+
+            for product in products:
+                quantity = rng.randint(1, 50)
+                expected = on_change_chain(sale, product, quantity)
+                line = Line.get_pos_line(sale, product, quantity)
+                for name in ['unit', 'unit_price', 'amount', 'amount_w_tax',
+                        'unit_price_w_tax']:
+                    self.assertEqual(
+                        getattr(line, name), getattr(expected, name), name)
+                self.assertEqual(list(line.taxes), list(expected.taxes))
+
+                quantity = rng.randint(1, 50)
+                expected.quantity = quantity
+                expected.unit_price = expected.compute_unit_price()
+                expected.amount = expected.on_change_with_amount()
+                expected.on_change_quantity()
+                expected.amount_w_tax = expected.on_change_with_amount_w_tax()
+                expected.unit_price_w_tax = (
+                    expected.on_change_with_unit_price_w_tax())
+                line.set_pos_quantity(quantity)
+                for name in ['unit_price', 'amount', 'amount_w_tax',
+                        'unit_price_w_tax']:
+                    self.assertEqual(
+                        getattr(line, name), getattr(expected, name), name)
+
+    @with_transaction()
+    def test_search_pos_codes(self):
+        'Test search POS codes with its cache and invalidation'
+        pool = Pool()
+        Product = pool.get('product.product')
+        Identifier = pool.get('product.identifier')
+
+        company = create_company()
+        with set_company(company):
+            product, other = self.create_products(
+                company, [Decimal('1'), Decimal('2')])
+            product.suffix_code = 'C1'
+            product.save()
+
+            self.assertEqual(Product.search_pos_codes(['C1', 'X1']), {
+                    'C1': [product],
+                    'X1': [],
+                    })
+            hit = Product._pos_code_cache.hit
+            self.assertEqual(Product.search_pos_code('C1'), [product])
+            self.assertGreater(Product._pos_code_cache.hit, hit)
+
+            Identifier.create([{'product': other.id, 'code': 'X1'}])
+            self.assertEqual(Product.search_pos_code('X1'), [other])
+
+            product.suffix_code = 'C2'
+            product.save()
+            self.assertEqual(Product.search_pos_code('C1'), [])
+            self.assertEqual(Product.search_pos_code('C2'), [product])
+
+            template = product.template
+            template.salable = False
+            template.save()
+            self.assertEqual(Product.search_pos_code('C2'), [])
+
+    @with_transaction()
+    def test_search_pos_products(self):
+        'Test search POS products by stages'
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        company = create_company()
+        with set_company(company):
+            pie, apple, pear = self.create_products(
+                company, [Decimal('1')] * 3)
+            for product, name in [
+                    (pie, 'Apple pie'),
+                    (apple, 'Green apple'),
+                    (pear, 'Pear'),
+                    ]:
+                product.suffix_code = name.upper()[:3]
+                product.save()
+            Template.write([pie.template], {'name': 'Apple pie'})
+            Template.write([apple.template], {'name': 'Green apple'})
+            Template.write([pear.template], {'name': 'Pear'})
+
+            self.assertEqual(Product.search_pos_products('GRE'), [apple])
+            self.assertEqual(Product.search_pos_products('apple'), [pie])
+            self.assertEqual(
+                set(Product.search_pos_products('pple')), {pie, apple})
+            self.assertEqual(Product.search_pos_products('Plum'), [])
+
+    @with_transaction()
+    def test_ticket_number_duplicates(self):
+        'Test ticket number duplicates are found'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            shop = self.create_shop(company)
+            sales = [self.pos_sale(company) for _ in range(2)]
+            for sale in sales:
+                sale.shop = shop
+            with Transaction().set_context(shops=[shop.id], shop=shop.id):
+                Sale.save(sales)
+            self.assertEqual(Sale._ticket_number_duplicates(), [])
+
+            # Sales numbered before the constraint was added
+            Sale.__table_handler__().drop_constraint(
+                'ticket_number_shop_unique')
+            table = Sale.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update([table.ticket_number], ['1'],
+                    where=table.id.in_([s.id for s in sales])))
+            self.assertEqual(
+                [tuple(r) for r in Sale._ticket_number_duplicates()],
+                [(company.id, shop.id, '1')])
+
+    @with_transaction()
+    def test_fill_pos_create_date(self):
+        'Test the POS create date is filled by chunks'
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            shop = self.create_shop(company)
+            sales = [self.pos_sale(company) for _ in range(3)]
+            for sale in sales:
+                sale.shop = shop
+            with Transaction().set_context(shops=[shop.id], shop=shop.id):
+                Sale.save(sales)
+
+            # Sales created before the POS create date was added
+            table = Sale.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update([table.pos_create_date], [Null],
+                    where=table.id.in_([s.id for s in sales])))
+
+            if not config.has_section('sale_pos'):
+                config.add_section('sale_pos')
+            config.set('sale_pos', 'pos_create_date_chunk', '1')
+            try:
+                with patch.object(Transaction(), 'commit') as commit:
+                    Sale.fill_pos_create_date()
+                    self.assertEqual(commit.call_count, len(sales))
+
+                    cursor.execute(*table.select(
+                            table.pos_create_date, table.create_date,
+                            where=table.id.in_([s.id for s in sales])))
+                    rows = cursor.fetchall()
+                    self.assertEqual(len(rows), len(sales))
+                    for pos_create_date, create_date in rows:
+                        self.assertIsNotNone(pos_create_date)
+                        self.assertEqual(pos_create_date, create_date)
+
+                    # Nothing left to fill
+                    commit.reset_mock()
+                    Sale.fill_pos_create_date()
+                    commit.assert_not_called()
+            finally:
+                config.remove_option('sale_pos', 'pos_create_date_chunk')
+
+    @with_transaction()
+    def test_pos_context(self):
+        'Test POS context is cached until the shop changes'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+        User = pool.get('res.user')
+
+        company = create_company()
+        with set_company(company):
+            party, other = Party.create([
+                    {'name': 'Customer'},
+                    {'name': 'Other'},
+                    ])
+            shop = self.create_shop(company)
+            shop.party = party
+            shop.save()
+            self.assertEqual(Sale.get_pos_context(),
+                {'shop': None, 'party': None})
+
+            user = User(Transaction().user)
+            user.shops = [shop]
+            user.shop = shop
+            user.save()
+            context = Sale.get_pos_context()
+            self.assertEqual(context, {'shop': shop.id, 'party': party.id})
+            self.assertIs(Sale.get_pos_context(), context)
+            self.assertEqual(Sale.default_party(), party.id)
+
+            shop.party = other
+            shop.save()
+            self.assertEqual(Sale.default_party(), other.id)
+
+    @with_transaction()
+    def test_pos_price_cache(self):
+        'Test POS price cache hits and invalidation'
+        pool = Pool()
+        PriceList = pool.get('product.price_list')
+        PriceListLine = pool.get('product.price_list.line')
+        Line = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            product, = self.create_products(company, [Decimal('10')])
+            sale = self.pos_sale(company)
+
+            def price():
+                "Return the unit price and the hit and miss of the cache"
+                before = Line.pos_price_cache_stats()
+                line = Line.get_pos_line(sale, product, 1)
+                after = Line.pos_price_cache_stats()
+                return (line.unit_price,
+                    after['hit'] - before['hit'],
+                    after['miss'] - before['miss'])
+
+            price()
+            unit_price, hit, miss = price()
+            self.assertEqual(unit_price, Decimal('10'))
+            self.assertTrue(hit)
+            self.assertFalse(miss)
+
+            template = product.template
+            template.list_price = Decimal('20')
+            template.save()
+            unit_price, hit, miss = price()
+            self.assertEqual(unit_price, Decimal('20'))
+            self.assertTrue(miss)
+
+            price_list = PriceList(name='Half', price='list_price',
+                lines=[PriceListLine(formula='unit_price')])
+            price_list.save()
+            sale.price_list = price_list
+            price()
+            unit_price, hit, miss = price()
+            self.assertEqual(unit_price, Decimal('20'))
+            self.assertFalse(miss)
+
+            price_list_line, = price_list.lines
+            price_list_line.formula = 'unit_price * 0.5'
+            price_list_line.save()
+            unit_price, hit, miss = price()
+            self.assertEqual(unit_price, Decimal('10'))
+            self.assertTrue(miss)
+
+    @with_transaction()
+    def test_pos_line_defaults(self):
+        'Test POS line defaults with and without the cache'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Line = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            sale = self.pos_sale(company)
+            cache = Line._pos_defaults_cache
+
+            def defaults(sale):
+                "Return the defaults and the hit and miss of the cache"
+                hit, miss = cache.hit, cache.miss
+                values = Line.get_pos_defaults(sale)
+                return values, cache.hit - hit, cache.miss - miss
+
+            values, _, _ = defaults(sale)
+            self.assertEqual(defaults(sale), (values, 1, 0))
+
+            other = Party(name='Other')
+            other.save()
+            sale.party = other
+            self.assertEqual(defaults(sale)[1:], (0, 1))
+
+            if not config.has_section('sale_pos'):
+                config.add_section('sale_pos')
+            config.set('sale_pos', 'line_defaults_cache', 'False')
+            try:
+                self.assertEqual(defaults(sale), (values, 0, 0))
+            finally:
+                config.remove_option('sale_pos', 'line_defaults_cache')
+
+    @with_transaction()
+    def test_pos_on_change_lines(self):
+        'Test POS totals reuse the taxes of the unchanged lines'
+        pool = Pool()
+        Line = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            products = self.create_products(company,
+                [Decimal('0.3333'), Decimal('1.2345'), Decimal('7.7777')])
+            sale = self.pos_sale(company)
+            sale.lines = [Line.get_pos_line(sale, p, 1) for p in products]
+
+            def totals(self_pick_up):
+                "Return the totals and the hit and miss of the cache"
+                sale.self_pick_up = self_pick_up
+                before = Line.pos_price_cache_stats()
+                sale.on_change_lines()
+                after = Line.pos_price_cache_stats()
+                return ((sale.untaxed_amount, sale.tax_amount,
+                        sale.total_amount),
+                    after['hit'] - before['hit'],
+                    after['miss'] - before['miss'])
+
+            expected, _, _ = totals(False)
+            amounts, _, _ = totals(True)
+            self.assertEqual(amounts, expected)
+            amounts, hit, miss = totals(True)
+            self.assertEqual(amounts, expected)
+            self.assertTrue(hit)
+            self.assertFalse(miss)
+
+            sale.lines[0].set_pos_quantity(3)
+            expected, _, _ = totals(False)
+            amounts, hit, _ = totals(True)
+            self.assertEqual(amounts, expected)
+            self.assertTrue(hit)
+
+    def test_pos_journal(self):
+        'Test POS journal'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'journal')
+            journal = PosJournal(path)
+            first = journal.record([('P1', 2)], [(1, Decimal('22.00'))])
+            second = journal.record([('P2', 1)], [(1, 0.1)],
+                self_pick_up=True)
+            with open(path, 'a') as file:
+                file.write('{"key": "trunc')
+
+            self.assertEqual([e['key'] for e in journal.pending()],
+                [first, second])
+            self.assertEqual(journal.pending()[0]['payments'],
+                [[1, '22.00']])
+            self.assertEqual(journal.pending()[1]['payments'], [[1, '0.1']])
+
+            replayed = []
+
+            def replay_pos_sales(entries):
+                replayed.extend(e['key'] for e in entries)
+                return {
+                    'sales': {first: 1},
+                    'unknown': {second: ['P2']},
+                    }
+            unknown = journal.replay(replay_pos_sales)
+            self.assertEqual(replayed, [first, second])
+            self.assertEqual(unknown, {second: ['P2']})
+            self.assertEqual([e['key'] for e in journal.pending()], [second])
+
+            journal.compact()
+            with open(path) as file:
+                self.assertEqual(len(file.readlines()), 1)
+            self.assertEqual([e['key'] for e in journal.pending()], [second])
+
+    def test_metrics_histogram(self):
+        'Test metrics histogram'
+        metrics.clear()
+        self.addCleanup(metrics.clear)
+        metrics.record('scan', 1, 2, 3, 1)
+        metrics.record('scan', 1, 2, 30, 2)
+        metrics.record('scan', 1, 2, 10000, 0)
+
+        histogram, = metrics.get()
+        self.assertEqual(
+            (histogram['stage'], histogram['shop'], histogram['user']),
+            ('scan', 1, 2))
+        self.assertEqual(histogram['count'], 3)
+        self.assertEqual(histogram['sum'], 10033)
+        self.assertEqual(histogram['max'], 10000)
+        self.assertEqual(histogram['writes'], 3)
+        buckets = dict(zip(histogram['bounds'] + [None],
+                histogram['buckets']))
+        self.assertEqual(buckets[5], 1)
+        self.assertEqual(buckets[50], 1)
+        self.assertEqual(buckets[None], 1)
+
+    def test_scan_parse(self):
+        'Test scan parse'
+        layouts = [
+            scan.Layout('21', 5, 'weight', 3),
+            scan.Layout('22', 5, 'price', 2),
+            ]
+        for value, result in [
+                ('', scan.Scan()),
+                ('5', scan.Scan(quantity=5)),
+                ('-1', scan.Scan(quantity=-1)),
+                ('2,5', scan.Scan(quantity=2.5)),
+                ('12345', scan.Scan('12345')),
+                ('ABC', scan.Scan('ABC')),
+                ('3*ABC', scan.Scan('ABC', 3)),
+                ('*4', scan.Scan(quantity=4)),
+                ('X*ABC', scan.Scan('X*ABC')),
+                ('2112345012506', scan.Scan('12345', quantity=1.25)),
+                ('2212345009954',
+                    scan.Scan('12345', amount=Decimal('9.95'))),
+                ('2112345012500', scan.Scan('2112345012500')),
+                ('2312345012504', scan.Scan('2312345012504')),
+                ('(01)09501101530003(3103)001250',
+                    scan.Scan('9501101530003', quantity=1.25)),
+                ('(01)09501101530003(3922)1299',
+                    scan.Scan('9501101530003', amount=Decimal('12.99'))),
+                (']C101195011015300001030\x1d3102000150',
+                    scan.Scan('19501101530000', quantity=1.5)),
+                ]:
+            with self.subTest(value=value):
+                self.assertEqual(scan.parse(value, layouts), result)
+
+    def test_ean_check_digit(self):
+        'Test EAN check digit'
+        self.assertEqual(scan.ean_check_digit('950110153000'), '3')
+        self.assertEqual(scan.ean_check_digit('211234501250'), '6')
+
 
 del ModuleTestCase
@@ -1,7 +1,9 @@
+import datetime
 import unittest
 from decimal import Decimal
 
-from proteus import Model, Wizard
+from proteus import Model, Report, Wizard
+from trytond.exceptions import UserError
 from trytond.modules.account.tests.tools import (create_chart,
                                                  create_fiscalyear, create_tax,
                                                  get_accounts)
@@ -220,3 +222,269 @@ class Test(unittest.TestCase):
         sale.reload()
         self.assertEqual(sale.paid_amount, Decimal('22.00'))
         self.assertEqual(sale.residual_amount, Decimal('0.00'))
+
+        # Sales recorded offline are replayed once on an open statement
+        open_statment = Wizard('open.statement')
+        open_statment.execute('create_')
+        replay_statement, = Statement.find([('state', '=', 'draft')])
+
+        product.suffix_code = 'POS1'
+        product.save()
+        entry = {
+            'key': 'till-1-0001',
+            'date': '2024-01-02T10:30:00',
+            'lines': [['POS1', 1]],
+            'payments': [[statement_journal.id, '11.00']],
+            }
+        result = Sale._proxy.replay_pos_sales([entry], config.context)
+        replayed_id = result['sales']['till-1-0001']
+        result = Sale._proxy.replay_pos_sales([entry], config.context)
+        self.assertEqual(result['sales'], {'till-1-0001': replayed_id})
+        replayed = Sale(replayed_id)
+        self.assertEqual(replayed.pos_create_date.isoformat(),
+            '2024-01-02T10:30:00')
+        self.assertEqual(replayed.total_amount, Decimal('11.00'))
+        self.assertEqual(len(replayed.invoices), 1)
+        self.assertEqual(len(replayed.payments), 1)
+        replay_statement.reload()
+        self.assertEqual(
+            [l.sale for l in replay_statement.lines], [replayed])
+
+        # Scan products keeping the state on the server
+        scanned = Sale()
+        scanned.save()
+        result = Sale._proxy.pos_scan(scanned.id, 'POS1', config.context)
+        line_id = result['line']['id']
+        result = Sale._proxy.pos_scan(scanned.id, 'POS1', config.context)
+        self.assertEqual(result['line']['id'], line_id)
+        self.assertEqual(result['line']['quantity'], 2.0)
+        result = Sale._proxy.pos_scan(scanned.id, '5', config.context)
+        self.assertEqual(result['line']['quantity'], 5.0)
+        self.assertEqual(result['total_amount'], Decimal('55.00'))
+        for value, quantity in [('*3', 3.0), ('4*', 4.0), ('2*POS1', 6.0)]:
+            result = Sale._proxy.pos_scan(scanned.id, value, config.context)
+            self.assertEqual(result['line']['id'], line_id)
+            self.assertEqual(result['line']['quantity'], quantity)
+        self.assertEqual(result['total_amount'], Decimal('66.00'))
+        result = Sale._proxy.pos_scan(scanned.id, 'unknown', config.context)
+        self.assertEqual(result, {'products': []})
+        with self.assertRaises(UserError):
+            Sale._proxy.pos_scan(
+                scanned.id, 'unknown', product.id, config.context)
+
+        # Scan quantities for the last product with the Add Products wizard
+        wizard_sale = Sale()
+        wizard_sale.save()
+        add_product = Wizard('sale_pos.add_product', [wizard_sale])
+        for value, quantity in [
+                ('POS1', 1.0), ('*3', 3.0), ('4*', 4.0), ('2*POS1', 6.0)]:
+            add_product.form.input_value = value
+            add_product.execute('scan_')
+            wizard_sale.reload()
+            wizard_line, = wizard_sale.lines
+            self.assertEqual(wizard_line.quantity, quantity)
+        add_product.execute('end')
+
+        # The Add Products wizard only saves the scanned lines
+        other_template = ProductTemplate()
+        other_template.name = 'other'
+        other_template.default_uom = unit
+        other_template.type = 'goods'
+        other_template.salable = True
+        other_template.list_price = Decimal('5')
+        other_template.account_category = account_category
+        other_template.save()
+        other_product, = other_template.products
+        other_product.suffix_code = 'POS2'
+        other_product.save()
+
+        basket = Sale()
+        basket.save()
+        add_product = Wizard('sale_pos.add_product', [basket])
+        for value in ['POS1', 'POS2', 'POS1']:
+            add_product.form.input_value = value
+            add_product.execute('scan_')
+        basket.reload()
+        self.assertEqual([(l.product, l.quantity) for l in basket.lines],
+            [(product, 2.0), (other_product, 1.0)])
+        _, other_line = basket.lines
+        self.assertEqual(other_line.write_date, None)
+        add_product.form.input_value = 'POS1'
+        add_product.execute('scan_')
+        add_product.execute('end')
+        basket.reload()
+        self.assertEqual([(l.product, l.quantity) for l in basket.lines],
+            [(product, 3.0), (other_product, 1.0)])
+        _, other_line = basket.lines
+        self.assertEqual(other_line.write_date, None)
+
+        # The line index of the wizard follows the lines removed from it
+        add_product = Wizard('sale_pos.add_product', [basket])
+        product_line, _ = add_product.form.lines
+        add_product.form.lines.remove(product_line)
+        for value in ['POS2', 'POS1']:
+            add_product.form.input_value = value
+            add_product.execute('scan_')
+        self.assertEqual(
+            [(l.product, l.quantity) for l in add_product.form.lines],
+            [(other_product, 2.0), (product, 1.0)])
+        add_product.execute('end')
+
+        # Append a new line for each scan
+        SaleConfiguration = Model.get('sale.configuration')
+        pos_config = SaleConfiguration(1)
+        pos_config.pos_append_lines = True
+        pos_config.save()
+        appended = Sale()
+        appended.save()
+        add_product = Wizard('sale_pos.add_product', [appended])
+        for value in ['POS1', 'POS1', '*3']:
+            add_product.form.input_value = value
+            add_product.execute('scan_')
+        add_product.execute('end')
+        appended.reload()
+        self.assertEqual([l.quantity for l in appended.lines], [1.0, 3.0])
+        for value in ['POS1', '4*']:
+            Sale._proxy.pos_scan(appended.id, value, config.context)
+        appended.reload()
+        self.assertEqual(
+            [l.quantity for l in appended.lines], [1.0, 3.0, 4.0])
+        pos_config.pos_append_lines = False
+        pos_config.save()
+
+        # Edit many lines at once
+        result = Sale._proxy.edit_pos_lines(scanned.id, [
+                {'id': line_id, 'quantity': 3},
+                ], config.context)
+        line, = result['lines']
+        self.assertEqual(line['quantity'], 3.0)
+        self.assertEqual(line['amount'], Decimal('30.00'))
+        self.assertEqual(result['total_amount'], Decimal('33.00'))
+        result = Sale._proxy.edit_pos_lines(scanned.id, [
+                {'id': line_id, 'unit_price': Decimal('20')},
+                ], config.context)
+        self.assertEqual(result['total_amount'], Decimal('66.00'))
+
+        # Add a list of codes merging the quantities of the same product
+        coded = Sale()
+        coded.save()
+        result = Sale._proxy.add_pos_codes(coded.id,
+            [['POS1', 2], ['POS1', 1], ['unknown', 1]], config.context)
+        self.assertEqual(result['unknown'], ['unknown'])
+        self.assertEqual(result['total_amount'], Decimal('33.00'))
+        coded.reload()
+        coded_line, = coded.lines
+        self.assertEqual(result['lines'], [coded_line.id])
+        self.assertEqual(coded_line.quantity, 3.0)
+
+        # The totals computed by the lines match the stored ones
+        rounding_template = ProductTemplate()
+        rounding_template.name = 'rounding'
+        rounding_template.default_uom = unit
+        rounding_template.type = 'goods'
+        rounding_template.salable = True
+        rounding_template.list_price = Decimal('0.3333')
+        rounding_template.account_category = account_category
+        rounding_template.save()
+        rounding_product, = rounding_template.products
+        for self_pick_up in [True, False]:
+            rounding_sale = Sale()
+            rounding_sale.self_pick_up = self_pick_up
+            for _ in range(3):
+                rounding_line = rounding_sale.lines.new()
+                rounding_line.product = rounding_product
+                rounding_line.quantity = 1
+            amounts = (rounding_sale.untaxed_amount,
+                rounding_sale.tax_amount, rounding_sale.total_amount)
+            rounding_sale.save()
+            rounding_sale.reload()
+            self.assertEqual(amounts, (rounding_sale.untaxed_amount,
+                    rounding_sale.tax_amount, rounding_sale.total_amount))
+            self.assertEqual(amounts,
+                (Decimal('0.99'), Decimal('0.10'), Decimal('1.09')))
+
+        # Close the paid self pick up sales of the day at once
+        today = datetime.date.today()
+        day_sales = []
+        for _ in range(2):
+            day_sale = Sale()
+            day_line = day_sale.lines.new()
+            day_line.product = product
+            day_line.quantity = 1
+            day_sale.save()
+            day_sales.append(day_sale)
+            statement_line = replay_statement.lines.new()
+            statement_line.date = today
+            statement_line.amount = Decimal('11.00')
+            statement_line.party = customer
+            statement_line.account = receivable
+            statement_line.sale = day_sale
+        replay_statement.save()
+
+        close_day = Wizard('sale_pos.close_day', [shop])
+        close_day.form.date = today
+        close_day.execute('close')
+        for day_sale in day_sales:
+            day_sale.reload()
+            self.assertEqual(day_sale.state, 'processing')
+            move, = day_sale.moves
+            self.assertEqual(move.quantity, 1.0)
+            self.assertEqual(move.state, 'done')
+            invoice, = day_sale.invoices
+            self.assertEqual(invoice.state, 'posted')
+
+        # Closing the day again skips the processed and the unpaid sales
+        unpaid_sale = Sale()
+        unpaid_line = unpaid_sale.lines.new()
+        unpaid_line.product = product
+        unpaid_line.quantity = 1
+        unpaid_sale.save()
+
+        close_day = Wizard('sale_pos.close_day', [shop])
+        close_day.form.date = today
+        close_day.execute('close')
+        unpaid_sale.reload()
+        self.assertEqual(unpaid_sale.state, 'draft')
+        self.assertEqual(len(unpaid_sale.moves), 0)
+        for day_sale in day_sales:
+            day_sale.reload()
+            self.assertEqual(day_sale.state, 'processing')
+            self.assertEqual(len(day_sale.moves), 1)
+            self.assertEqual(len(day_sale.invoices), 1)
+
+        # Print the tickets of many sales at once numbering only the paid ones
+        Configuration = Model.get('sale.configuration')
+        ActionReport = Model.get('ir.action.report')
+        sale_config = Configuration(1)
+        sale_config.ticket_report, = ActionReport.find([
+                ('report_name', '=', 'sale.sale'),
+                ])
+        sale_config.save()
+        Sale._proxy.print_ticket(
+            [s.id for s in day_sales + [unpaid_sale]], config.context)
+        for day_sale in day_sales:
+            day_sale.reload()
+        unpaid_sale.reload()
+        ticket_numbers = [s.ticket_number for s in day_sales]
+        self.assertTrue(all(ticket_numbers))
+        self.assertEqual(len(set(ticket_numbers)), 2)
+        self.assertEqual(unpaid_sale.ticket_number, None)
+        with self.assertRaises(UserError):
+            Sale._proxy.write([unpaid_sale.id],
+                {'ticket_number': ticket_numbers[0]}, config.context)
+
+        # Reprinting a ticket serves the stored one until the sale changes
+        ticket_sale = day_sales[0]
+        ticket_report = Report('sale.sale')
+        ext, _, _, _ = ticket_report.execute([ticket_sale])
+        self.assertNotEqual(ext, 'txt')
+        ticket_action = sale_config.ticket_report
+        ticket_action.template_extension = 'txt'
+        ticket_action.report_content = b'Ticket'
+        ticket_action.save()
+        self.assertEqual(ticket_report.execute([ticket_sale])[0], ext)
+        ticket_sale.comment = 'Reprinted'
+        ticket_sale.save()
+        ext, content, _, _ = ticket_report.execute([ticket_sale])
+        self.assertEqual(ext, 'txt')
+        self.assertEqual(content, 'Ticket')
@@ -0,0 +1,161 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+
+from sql import Literal
+from sql.aggregate import Count, Max
+from sql.conditionals import Coalesce
+
+from trytond import backend
+from trytond.config import config
+from trytond.model import Index, ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction, without_check_access
+
+logger = logging.getLogger(__name__)
+
+
+class TicketCache(ModelSQL):
+    "POS Ticket Cache"
+    __name__ = 'sale_pos.ticket_cache'
+    sale = fields.Many2One('sale.sale', "Sale", required=True,
+        ondelete='CASCADE')
+    action = fields.Many2One('ir.action.report', "Action", required=True,
+        ondelete='CASCADE')
+    language = fields.Char("Language")
+    key = fields.Char("Key", required=True)
+    format = fields.Char("Format", required=True)
+    text = fields.Boolean("Text")
+    content = fields.Binary("Content")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.sale, Index.Equality()), (t.action, Index.Equality())))
+
+    @classmethod
+    def size(cls):
+        "Return the maximum number of tickets to keep, 0 disables the cache"
+        return config.getint('sale_pos', 'ticket_cache_size', default=1000)
+
+    @classmethod
+    def is_ticket(cls, sale, action):
+        pool = Pool()
+        Config = pool.get('sale.configuration')
+        if not sale.ticket_number or cls.size() <= 0:
+            return False
+        ticket_report = Config(1).ticket_report
+        return bool(ticket_report) and ticket_report.id == action.id
+
+    @classmethod
+    def get_key(cls, sale):
+        """
+        Return the key of the rendered ticket of sale.
+        It changes with the ticket number and whenever the sale or any of its
+        lines is modified.
+        """
+        pool = Pool()
+        Line = pool.get('sale.line')
+        line = Line.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*line.select(
+                Max(Coalesce(line.write_date, line.create_date)),
+                Count(Literal('*')),
+                where=line.sale == sale.id))
+        lines_date, lines_count = cursor.fetchone()
+        return '|'.join(str(v) for v in [
+                sale.ticket_number, sale.write_date or sale.create_date,
+                lines_date, lines_count])
+
+    @classmethod
+    def get(cls, sale, action, key):
+        "Return the cached format and content of the ticket or None"
+        caches = cls.search([
+                ('sale', '=', sale.id),
+                ('action', '=', action.id),
+                ('language', '=', Transaction().language),
+                ('key', '=', key),
+                ], limit=1)
+        if not caches:
+            return
+        cache, = caches
+        content = cache.content
+        if cache.text:
+            content = bytes(content).decode('utf-8')
+        return cache.format, content
+
+    @classmethod
+    def set(cls, sale, action, key, format_, content):
+        """
+        Store the rendered ticket and evict the oldest ones above the size.
+        Printing is read-only so it is stored in a separate transaction and a
+        failure to store it does not prevent the ticket to be printed.
+        """
+        transaction = Transaction()
+        try:
+            if transaction.readonly:
+                with transaction.new_transaction() as transaction:
+                    with without_check_access():
+                        cls._set(sale.id, action.id, key, format_, content)
+                    transaction.commit()
+            else:
+                cls._set(sale.id, action.id, key, format_, content)
+        except backend.DatabaseOperationalError:
+            logger.debug("Could not store ticket of sale %s", sale.id,
+                exc_info=True)
+
+    @classmethod
+    def _set(cls, sale_id, action_id, key, format_, content):
+        language = Transaction().language
+        cls.delete(cls.search([
+                    ('sale', '=', sale_id),
+                    ('action', '=', action_id),
+                    ('language', '=', language),
+                    ]))
+        text = isinstance(content, str)
+        cache, = cls.create([{
+                    'sale': sale_id,
+                    'action': action_id,
+                    'language': language,
+                    'key': key,
+                    'format': format_,
+                    'text': text,
+                    'content': content.encode('utf-8') if text else content,
+                    }])
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete(where=table.id <= cache.id - cls.size()))
+
+
+class TicketCacheMixin:
+    """
+    Mixin for reports to serve the ticket report of a sale from
+    sale_pos.ticket_cache as long as the sale and its lines are unchanged.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def _execute(cls, records, header, data, action):
+        pool = Pool()
+        TicketCache = pool.get('sale_pos.ticket_cache')
+        if len(records) != 1 or records[0].__name__ != 'sale.sale':
+            return super()._execute(records, header, data, action)
+        sale, = records
+        with without_check_access():
+            is_ticket = TicketCache.is_ticket(sale, action)
+            if is_ticket:
+                key = TicketCache.get_key(sale)
+                result = TicketCache.get(sale, action, key)
+        if not is_ticket:
+            return super()._execute(records, header, data, action)
+        if result is None:
+            result = super()._execute(records, header, data, action)
+            with without_check_access():
+                TicketCache.set(sale, action, key, *result)
+        return result
+
+
+class SaleReport(TicketCacheMixin, metaclass=PoolMeta):
+    __name__ = 'sale.sale'